@@ -0,0 +1,124 @@
+import icalendar
+
+from threading import Lock
+
+from plone.app.event.base import default_timezone
+from plone.app.event.ical.exporter import PRODID, VERSION, add_to_zones_map
+from plone.event.interfaces import IEventAccessor
+from plone.event.interfaces import IICalendarEventComponent
+from seantis.dir.events import utils
+
+# construct_icalendar rebuilds every VEVENT on each request, which is slow
+# for the feeds polled by calendar clients - the feeds are therefore put
+# together from the serialized VEVENTs, by url, uid and modification date
+fragments = utils.LRUCache(5000)
+fragments_lock = Lock()
+
+# the assembled feeds by query
+feeds = utils.LRUCache(50)
+feeds_lock = Lock()
+
+
+def fragment(brain):
+    """ Returns the serialized VEVENT of the given event brain, together
+    with the timezone, start, end and whole day flag of the event, which
+    are needed for the timezone definitions of the feed.
+
+    """
+    key = (brain.getURL(), brain.UID, brain.modified)
+
+    with fragments_lock:
+        result = fragments.get(key)
+
+    if result is None:
+        event = brain.getObject()
+        accessor = IEventAccessor(event)
+
+        result = (
+            IICalendarEventComponent(event).to_ical().to_ical(),
+            accessor.timezone,
+            accessor.start,
+            accessor.end,
+            accessor.whole_day
+        )
+
+        with fragments_lock:
+            fragments[key] = result
+
+    return result
+
+
+def timezone_components(tzmap):
+    """ Returns the VTIMEZONE components of the given zones map, the same
+    way construct_icalendar does.
+
+    """
+    for (tzid, transitions) in tzmap.items():
+        cal_tz = icalendar.Timezone()
+        cal_tz.add('tzid', tzid)
+        cal_tz.add('x-lic-location', tzid)
+
+        for (transition, tzinfo) in transitions.items():
+
+            if tzinfo['dst']:
+                cal_tz_sub = icalendar.TimezoneDaylight()
+            else:
+                cal_tz_sub = icalendar.TimezoneStandard()
+
+            cal_tz_sub.add('tzname', tzinfo['name'])
+            cal_tz_sub.add('dtstart', transition)
+            cal_tz_sub.add('tzoffsetfrom', tzinfo['tzoffsetfrom'])
+            cal_tz_sub.add('tzoffsetto', tzinfo['tzoffsetto'])
+            cal_tz.add_component(cal_tz_sub)
+
+        yield cal_tz
+
+
+def assemble(context, brains):
+    """ Returns the serialized calendar of the given event brains, like
+    construct_icalendar(context, brains).to_ical() would.
+
+    """
+    cal = icalendar.Calendar()
+    cal.add('prodid', PRODID)
+    cal.add('version', VERSION)
+
+    cal_tz = default_timezone(context)
+    if cal_tz:
+        cal.add('x-wr-timezone', cal_tz)
+
+    tzmap = {}
+    events = []
+
+    for brain in brains:
+        ical, tz, start, end, whole_day = fragment(brain)
+
+        # whole day events are exported as dates without timezone
+        if not whole_day:
+            tzmap = add_to_zones_map(tzmap, tz, start)
+            tzmap = add_to_zones_map(tzmap, tz, end)
+
+        events.append(ical)
+
+    for component in timezone_components(tzmap):
+        cal.add_component(component)
+
+    head, tail = cal.to_ical().rsplit('END:VCALENDAR', 1)
+    return head + ''.join(events) + 'END:VCALENDAR' + tail
+
+
+def cached_feed(key, render):
+    """ Returns the feed with the given key, calling render to assemble it
+    if it is not cached yet. The key must change whenever the feed does.
+
+    """
+    with feeds_lock:
+        feed = feeds.get(key)
+
+    if feed is None:
+        feed = render()
+
+        with feeds_lock:
+            feeds[key] = feed
+
+    return feed
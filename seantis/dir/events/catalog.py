@@ -1,18 +1,30 @@
+import heapq
 import logging
 import transaction
 
-from blist import sortedset
+from BTrees.IIBTree import (
+    IISet,
+    IITreeSet,
+    difference,
+    intersection,
+    multiunion
+)
+from BTrees.IOBTree import IOBTree
+from BTrees.OOBTree import OOBTree
+from AccessControl import getSecurityManager
+from bisect import bisect_left
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 from five import grok
-from functools import partial
 from itertools import ifilter, islice
 from plone.app.event.ical.exporter import construct_icalendar
 from plone.memoize import instance
 from plone.synchronize import synchronized
+from pytz import utc
 from Products.CMFCore.interfaces import IActionSucceededEvent
 from seantis.dir.base.catalog import DirectoryCatalog
 from seantis.dir.base.interfaces import IDirectoryCatalog
-from seantis.dir.base.utils import previous_and_next
+from seantis.dir.events import calendars
 from seantis.dir.events import dates
 from seantis.dir.events import recurrence
 from seantis.dir.events import utils
@@ -22,6 +34,10 @@ from seantis.dir.events.interfaces import (
     IExternalEvent,
     IExternalEventSource
 )
+from seantis.dir.events.storage import (
+    IntegerIds,
+    PersistentSortedIntegerSet
+)
 from threading import Lock
 from transaction._transaction import AbortSavepoint
 from transaction.interfaces import ISavepointDataManager
@@ -36,6 +52,10 @@ from zope.lifecycleevent.interfaces import (
 
 log = logging.getLogger('seantis.dir.events')
 
+# the submitted counts by directory, modification date, date range and user
+submitted_counts = utils.LRUCache(100)
+submitted_counts_lock = Lock()
+
 
 # this is just awful
 # http://plone.293351.n2.nabble.com/Event-on-object-deletion-td3670562.html
@@ -50,6 +70,16 @@ class ReindexDataManager(object):
         self.directory = directory
         self.transaction_manager = transaction.manager
 
+        # the ids of the items touched during the transaction, if None the
+        # whole directory is reindexed
+        self.ids = set()
+
+    def add(self, id=None):
+        if id is None:
+            self.ids = None
+        elif self.ids is not None:
+            self.ids.add(id)
+
     def tpc_begin(self, transaction):
         pass
 
@@ -63,7 +93,10 @@ class ReindexDataManager(object):
         # We need to reindex the directory during the transaction since we
         # we store the index (as text) in the annotations (which itself
         # is an attribute of the directory and therefore stored in the ZODB)
-        reindex_directory(self.directory)
+        if self.ids is None:
+            reindex_directory(self.directory)
+        else:
+            update_directory(self.directory, self.ids)
 
     def abort(self, transaction):
         pass
@@ -79,28 +112,41 @@ class ReindexDataManager(object):
         return AbortSavepoint(self, transaction.get())
 
 
-def reindex_already_attached():
+def attached_data_manager(directory):
+    path = directory.getPhysicalPath()
+
     for resource in transaction.get()._resources:
         if isinstance(resource, ReindexDataManager):
-            return True
+            if resource.directory.getPhysicalPath() == path:
+                return resource
 
-    return False
+    return None
 
 
 _attach_lock = Lock()
 
 
 @synchronized(_attach_lock)
-def attach_reindex_to_transaction(directory):
+def attach_reindex_to_transaction(directory, id=None):
+    """ Reindexes the given directory at the end of the transaction. If an
+    item id is given, only the indices of the given item are updated.
+
+    """
     assert directory is not None
 
     request = getattr(directory, 'REQUEST', None)
 
-    if request and not reindex_already_attached():
-        transaction.get().join(ReindexDataManager(request, directory))
-
     if not request:
         log.warn('request not found')
+        return
+
+    manager = attached_data_manager(directory)
+
+    if manager is None:
+        manager = ReindexDataManager(request, directory)
+        transaction.get().join(manager)
+
+    manager.add(id)
 
 
 def may_reindex_directory(directory):
@@ -121,46 +167,107 @@ def reindex_directory(directory):
         utils.get_catalog(directory).reindex()
 
 
+def update_directory(directory, ids):
+    if may_reindex_directory(directory):
+        utils.get_catalog(directory).update(ids)
+
+
 @grok.subscribe(IEventsDirectoryItem, IObjectRemovedEvent)
 def onRemovedItem(item, event):
-    attach_reindex_to_transaction(event.oldParent)
+    attach_reindex_to_transaction(event.oldParent, event.oldName)
 
 
 @grok.subscribe(IEventsDirectoryItem, IObjectMovedEvent)
 def onMovedItem(item, event):
     if event.oldParent is not None:
-        attach_reindex_to_transaction(event.oldParent)
+        attach_reindex_to_transaction(event.oldParent, event.oldName)
     if event.newParent is not None:
-        attach_reindex_to_transaction(event.newParent)
+        attach_reindex_to_transaction(event.newParent, event.newName)
 
 
 @grok.subscribe(IEventsDirectoryItem, IObjectModifiedEvent)
 @grok.subscribe(IEventsDirectoryItem, IActionSucceededEvent)
 def onModifiedItem(item, event):
-    attach_reindex_to_transaction(item.get_parent())
+    attach_reindex_to_transaction(item.get_parent(), item.id)
 
 
 class LazyList(object):
+    """ A list whose items are resolved on first access.
+
+    If a get_items function is given, slices are resolved in one go and
+    accessing a single item which is not resolved yet resolves the window
+    of items starting with it (e.g. set to the page size of a Batch, which
+    accesses the items of a page one by one).
 
-    def __init__(self, get_item, length):
+    """
+
+    def __init__(self, get_item, length, get_items=None, window=1):
         assert callable(get_item)
+        assert get_items is None or callable(get_items)
+        assert window >= 1
 
         self._get_item = get_item
+        self._get_items = get_items
         self.length = length
+        self.window = window
         self.cache = [get_item] * length
 
     def get_item(self, index):
         if self.cache[index] == self._get_item:
-            self.cache[index] = self.cache[index](index)
+            if self._get_items is not None and self.window > 1:
+                end = min(index + self.window, self.length)
+                self.get_items(range(index, end))
+            else:
+                self.cache[index] = self.cache[index](index)
 
         return self.cache[index]
 
+    def get_items(self, indices):
+        """ Returns the items at the given indices, resolving the ones not
+        yet cached in one go if possible.
+
+        """
+        if self._get_items is not None:
+            missing = [i for i in indices if self.cache[i] == self._get_item]
+
+            if missing:
+                for index, item in zip(missing, self._get_items(missing)):
+                    self.cache[index] = item
+
+        return map(self.get_item, indices)
+
     def __len__(self):
         return self.length
 
+    def __iter__(self):
+        """ Yields the items, resolving them window by window. Items which
+        were not resolved before are not kept, so iterating through the
+        list uses a bounded amount of memory.
+
+        """
+        if self._get_items is None:
+            for index in xrange(self.length):
+                yield self.get_item(index)
+            return
+
+        for start in xrange(0, self.length, self.window):
+            indices = range(start, min(start + self.window, self.length))
+            missing = [i for i in indices if self.cache[i] == self._get_item]
+
+            if missing:
+                resolved = dict(zip(missing, self._get_items(missing)))
+            else:
+                resolved = {}
+
+            for index in indices:
+                if index in resolved:
+                    yield resolved[index]
+                else:
+                    yield self.cache[index]
+
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return map(self.get_item, range(*key.indices(self.length)))
+            return self.get_items(range(*key.indices(self.length)))
 
         if (key + 1) > self.length:
             raise IndexError
@@ -170,7 +277,7 @@ class LazyList(object):
 
 class EventIndex(object):
 
-    version = "1"
+    version = "3"
 
     def __init__(self, catalog, initial_index=None):
         self.catalog = catalog
@@ -182,17 +289,18 @@ class EventIndex(object):
         if initial_index is not None:
             self.index = initial_index
 
-        if not self.index:
+        # an empty index is built already, e.g. for a state without events
+        if self.index is None:
             self.reindex()
 
     @property
     def name(self):
         raise NotImplementedError
 
-    def update(self, events):
+    def update(self, events, ids=None):
         raise NotImplementedError
 
-    def remove(self, events):
+    def remove(self, ids):
         raise NotImplementedError
 
     def reindex(self, events=[]):
@@ -217,6 +325,35 @@ class EventIndex(object):
 
     index = property(get_index, set_index)
 
+    @property
+    def ids_key(self):
+        return 'seantis.dir.events.eventids-' + self.version
+
+    @property
+    def ids(self):
+        """ Returns the integer ids of the events, which are shared by all
+        indices of the directory.
+
+        """
+        ids = self.annotations.get(self.ids_key, None)
+
+        if ids is None:
+            ids = self.annotations[self.ids_key] = IntegerIds()
+
+        return ids
+
+    def intids(self, events):
+        """ Returns the integer ids of the given events (brains), leaving
+        out the events which were never indexed. Integer ids are returned
+        as they are.
+
+        """
+        if isinstance(events, (IISet, IITreeSet)):
+            return events
+
+        intids = (self.ids.get(event.id) for event in events)
+        return IITreeSet(intid for intid in intids if intid is not None)
+
     def get_metadata(self, key):
         return self.annotations.get(self.meta_key(key), None)
 
@@ -230,28 +367,38 @@ class EventIndex(object):
 
         return self.catalog.spawn(real, start, end)
 
-    def event_by_id_and_date(self, id, date):
+    def occurrence(self, real, date):
+        """ Returns the occurrence of the given event starting at the given
+        date (the local start as utc, without seconds - as stored in the
+        index).
 
-        real = self.catalog.catalog(
-            path={'query': self.catalog.path, 'depth': 1},
-            object_provides=IEventsDirectoryItem.__identifier__,
-            review_state=self.state,
-            id=id
-        )[0].getObject()
+        Since the index only contains existing occurrences the occurrence
+        can be created directly, without expanding the recurrence again.
+        Only events lasting multiple days are split into days when indexed,
+        those are looked up by spawning them.
+
+        """
+        local_start, local_end = real.local_start, real.local_end
+
+        if dates.split_days_count(local_start, local_end):
+            return self.spawned_occurrence(real, date)
 
-        # there is currently no way to easily look up the event by date
-        # if it has been split over dates already (which is what happens
-        # when the events are indexed)
+        if not real.recurrence:
+            return recurrence.Occurrence(real, real.start, real.end)
 
-        # therefore we need to currently loop over all events to find the
-        # right one. certainly this can be optimized.
+        start = real.tz.localize(dates.delete_timezone(date).replace(
+            second=local_start.second, microsecond=local_start.microsecond
+        ))
 
-        # however, tests on a 10k sites with 60% of all events being recurrent
-        # indicate that it's not that big of a problem. spawning events is
-        # quite fast and it only happens for 10 items per request
+        return recurrence.Occurrence(
+            real, start, start + (real.end - real.start)
+        )
 
-        # still, I would prefer some kind of lookup here
+    def spawned_occurrence(self, real, date):
 
+        # there is no way to easily look up the event by date if it has been
+        # split over dates already (which is what happens when the events are
+        # indexed), so the occurrences around the date are spawned
         min_date = date - timedelta(days=1)
         max_date = date + timedelta(days=1)
 
@@ -262,7 +409,7 @@ class EventIndex(object):
             if start == date:
                 return item
 
-        assert False, "lookup for %s failed" % id
+        assert False, "lookup for %s failed" % real.id
 
 
 class EventOrderIndex(EventIndex):
@@ -270,116 +417,216 @@ class EventOrderIndex(EventIndex):
     def __init__(self, catalog, state, initial_index=None):
         assert state in ('submitted', 'published', 'archived', 'hidden')
         self.state = state
+
+        # the catalog lives as long as the request, so do the occurrences
+        # resolved through this cache, which the templates access repeatedly
+        self.resolved = utils.LRUCache(self.resolved_size)
+
         super(EventOrderIndex, self).__init__(catalog, initial_index)
 
+        # the reverse index is rebuilt from the given index on demand
+        if initial_index is not None:
+            self.set_metadata('identities', None)
+
+    # The identities are integers with the minutes since the epoch of the
+    # local start in the upper bits and the integer id of the event in the
+    # lower bits. Sorting the identities therefore sorts them by date.
+    id_bits = 32
+    id_mask = (1 << id_bits) - 1
+    epoch = datetime(1970, 1, 1)
+
+    resolved_size = 500
+
     @property
     def name(self):
         return 'eventorder-%s' % self.state
 
+    def key(self, date, id):
+        """ Returns the identity of the event with the given id, starting at
+        the given (naive) date.
+
+        """
+        minutes = int((date - self.epoch).total_seconds()) // 60
+        return (minutes << self.id_bits) | self.ids.register(id)
+
+    def day_key(self, day):
+        """ Returns the lowest possible identity on the given day. """
+        minutes = (day - self.epoch.date()).days * 24 * 60
+        return minutes << self.id_bits
+
     def identity(self, event):
         date = dates.delete_timezone(event.local_start)
-        return '%s;%s' % (date.strftime('%y.%m.%d-%H:%M'), event.id)
+        return self.key(date, event.id)
 
     def identity_id(self, identity):
-        return identity[15:]
+        return self.ids.name(identity & self.id_mask)
 
     def identity_date(self, identity):
-        return dates.to_utc(datetime.strptime(identity[:14], '%y.%m.%d-%H:%M'))
+        minutes = identity >> self.id_bits
+        return (self.epoch + timedelta(minutes=minutes)).replace(tzinfo=utc)
+
+    def identity_day(self, identity):
+        days = (identity >> self.id_bits) // (24 * 60)
+        return self.epoch.date() + timedelta(days=days)
+
+    def identity_repr(self, identity):
+        return '%s;%s' % (
+            self.identity_date(identity).strftime('%y.%m.%d-%H:%M'),
+            self.identity_id(identity)
+        )
 
     def event_by_identity(self, identity):
+        return self.events_by_identities([identity])[0]
 
-        id = self.identity_id(identity)
-        date = self.identity_date(identity)
+    def events_by_identities(self, identities):
+        """ Returns the occurrences of the given identities, looking up all
+        events not resolved before with a single catalog query.
 
-        return self.event_by_id_and_date(id, date)
+        """
+        # the cache may hold less identities than requested, so the result
+        # is collected separately
+        result = {}
+        missing = []
+
+        for identity in identities:
+            occurrence = self.resolved.get(identity)
+
+            if occurrence is None:
+                missing.append(identity)
+            else:
+                result[identity] = occurrence
+
+        if missing:
+            brains = self.catalog.catalog(
+                path={'query': self.catalog.path, 'depth': 1},
+                object_provides=IEventsDirectoryItem.__identifier__,
+                review_state=self.state,
+                id=list(set(self.identity_id(i) for i in missing))
+            )
+
+            reals = dict((brain.id, brain.getObject()) for brain in brains)
+
+            for identity in missing:
+                result[identity] = self.resolved[identity] = self.occurrence(
+                    reals[self.identity_id(identity)],
+                    self.identity_date(identity)
+                )
+
+        return [result[identity] for identity in identities]
 
     def reindex(self):
 
         events = self.catalog.query(review_state=self.state)
 
         if self.index or self.index is None:
-            self.index = sortedset()
+            self.index = PersistentSortedIntegerSet()
+
+        self.set_metadata('identities', OOBTree())
 
         self.update(events)
-        self.generate_metadata()
 
-    def update(self, events):
-        if events:
-            self.remove(events)
+    @property
+    def identities(self):
+        """ Returns the reverse index, containing the identities in the
+        index by event id. The reverse index is built from the index if it
+        doesn't exist yet.
+
+        """
+        identities = self.get_metadata('identities')
 
-        managed = (e for e in events if e.review_state == self.state)
+        if identities is None:
+            by_id = defaultdict(list)
 
-        for event in self.spawn_events(managed):
-            self.index.add(self.identity(event))
+            for identity in self.index or ():
+                by_id[self.identity_id(identity)].append(identity)
+
+            identities = OOBTree()
+
+            for id, values in by_id.iteritems():
+                identities[id] = tuple(values)
+
+            self.set_metadata('identities', identities)
 
-    def remove(self, events):
-        assert events
+        return identities
 
-        ids = [r.id for r in events]
-        stale = set(i for i in self.index if self.identity_id(i) in ids)
+    def update(self, events, ids=None):
+        """ Updates the index with the given events (brains). The ids of
+        all events given and the additional ids (of events which have left
+        the state or were removed) are removed from the index first.
 
-        self.index = sortedset(self.index - stale)
+        Returns the identities that were added or removed.
 
-    def generate_metadata(self):
-        """Creates a metaindex, indexing the date positions by date.
-        For example:
+        """
+        ids = set(ids or ())
+        ids.update(e.id for e in events)
+
+        managed = [e for e in events if e.review_state == self.state]
+
+        new = defaultdict(set)
+        for event in self.spawn_events(managed):
+            new[event.id].add(self.identity(event))
 
-        Events:
-            0 -> 01.01.2012
-            1 -> 05.01.2012
-            2 -> 06.01.2012
+        changed = set()
+        for id in ids:
+            changed.update(self.replace(id, new.get(id, ())))
 
-        Resulting metaindex:
-            01.01.2012 -> 0
-            02.01.2012 -> 1
-            03.01.2012 -> 1
-            04.01.2012 -> 1
-            05.01.2012 -> 1
-            06.01.2012 -> 2
+        return changed
 
-        The idea is for every possible date between the first event
-        and the last event to point to an event in the index. This allows
-        for fast pagination using slicing.
+    def remove(self, ids):
+        """ Removes the events with the given ids from the index and returns
+        the removed identities.
 
         """
+        assert ids
 
-        if not self.index:
-            if self.get_metadata('dateindex'):
-                self.set_metadata('dateindex', None)
-            return
+        removed = set()
+        for id in ids:
+            removed.update(self.replace(id, ()))
 
-        dt = lambda i: i if i is None else self.identity_date(i).date()
+        return removed
 
-        keydates = {}
+    def replace(self, id, identities):
+        """ Replaces the identities of the event with the given id. Only
+        the identities of this event are looked at, using the reverse index.
+        The index is only written if it changed.
 
-        # set the key positions (first occurrence of each date)
-        for ix, date in enumerate(map(dt, self.index)):
-            if date not in keydates:
-                keydates[date] = ix
+        Returns the identities that were added or removed.
 
-        # fill the gaps
-        dateindex = {}
-        for prev, curr, next in previous_and_next(sorted(keydates.keys())):
-            if prev is None:
-                continue
-            if prev == curr:
-                continue
+        """
+        # resolved occurrences may be outdated once the event changed
+        self.resolved.clear()
 
-            for date in dates.days_between(prev, curr):
-                dateindex[date] = keydates[curr]
+        reverse = self.identities
 
-        # merge
-        dateindex.update(keydates)
+        old = set(reverse.get(id, ()))
+        new = set(identities)
 
-        self.set_metadata('dateindex', dateindex)
+        if old == new:
+            return set()
 
-    def by_range(self, start, end):
+        index = self.index
 
-        if not start and not end:
-            return self.index
+        for identity in old - new:
+            index.discard(identity)
+
+        for identity in new - old:
+            index.add(identity)
 
+        if new:
+            reverse[id] = tuple(sorted(new))
+        else:
+            del reverse[id]
+
+        return old ^ new
+
+    def bounds(self, start, end):
+        """ Returns the lowest identity possible between start and end and
+        the lowest identity possible after, or None if no indexed event
+        lies in between.
+
+        """
         if not self.index:
-            return []
+            return None
 
         first_date = self.identity_date(self.index[0])
         last_date = self.identity_date(self.index[-1])
@@ -392,9 +639,7 @@ class EventOrderIndex(EventIndex):
         ) + timedelta(days=1, microseconds=-1)
 
         if not dates.overlaps(first_date, last_date, start, end):
-            return []
-
-        dateindex = self.get_metadata('dateindex')
+            return None
 
         # use whatever timezone is given, because a search for a range cannot
         # be normalized, since the day of this search is not really a concept
@@ -402,32 +647,304 @@ class EventOrderIndex(EventIndex):
         start = (start or first_date).date()
         end = (end or last_date).date()
 
-        if start <= first_date.date():
-            startrange = 0
-        else:
-            startrange = dateindex[start]
+        return self.day_key(start), self.day_key(end + timedelta(days=1))
 
-        if end >= last_date.date():
-            endrange = len(self.index)
-        else:
-            endrange = dateindex[end + timedelta(days=1)]
+    def by_range(self, start, end):
+
+        if not start and not end:
+            return self.index
+
+        bounds = self.bounds(start, end)
+
+        if bounds is None:
+            return []
+
+        # the identities are sorted by date, so the first identity of a day
+        # (or of the next day with events) is found through bisection
+        startrange = self.index.bisect_left(bounds[0])
+        endrange = self.index.bisect_left(bounds[1])
 
         return self.index[startrange:endrange]
 
-    def limit_to_subset(self, index, subset):
+    def by_subset(self, start, end, subset):
+        """ Returns the identities between start and end of the events in
+        the given subset (brains or integer ids).
+
+        The sorted identities of each event are taken from the reverse index
+        and merged, so this depends on the number of occurrences of the
+        subset, not on the number of occurrences in the range.
+
+        """
+        if start or end:
+            bounds = self.bounds(start, end)
+
+            if bounds is None:
+                return []
+        else:
+            bounds = None
+
+        reverse = self.identities
+        postings = []
+
+        for intid in self.intids(subset):
+            identities = reverse.get(self.ids.name(intid))
+
+            if not identities:
+                continue
+
+            if bounds is not None:
+                identities = identities[
+                    bisect_left(identities, bounds[0]):
+                    bisect_left(identities, bounds[1])
+                ]
+
+            if identities:
+                postings.append(identities)
+
+        return list(heapq.merge(*postings))
+
+    def counts(self, start, end):
+        """ Returns the number of occurrences between start and end by
+        event id.
+
+        """
+        counts = self.occurrences(start, end)
+
+        return dict(
+            (self.ids.name(intid), count) for intid, count in counts.items()
+        )
 
+    def occurrences(self, start, end, subset=None):
+        """ Returns the number of occurrences between start and end by
+        integer id, limited to the given subset (brains or integer ids).
+
+        """
         if subset is None:
-            return index
+            identities = self.by_range(start, end)
+        else:
+            identities = self.by_subset(start, end, subset)
 
-        ids = set(brain.id for brain in subset)
-        return filter(lambda i: self.identity_id(i) in ids, index)
+        return Counter(i & self.id_mask for i in identities)
 
     def lazy_list(self, start, end, subset=None):
-        subindex = self.by_range(start, end)
-        subindex = self.limit_to_subset(subindex, subset)
+        if subset is None:
+            subindex = self.by_range(start, end)
+        else:
+            subindex = self.by_subset(start, end, subset)
+
         get_item = lambda i: self.event_by_identity(subindex[i])
+        get_items = lambda indices: self.events_by_identities(
+            [subindex[i] for i in indices]
+        )
+
+        return LazyList(get_item, len(subindex), get_items)
+
+
+class EventCategoryIndex(EventIndex):
+    """ Maps each category value to the integer ids of the events having
+    it, so that filters and the counts of the values are computed without
+    looking at the events themselves.
+
+    """
+
+    def __init__(self, catalog, state, initial_index=None):
+        assert state in ('submitted', 'published', 'archived', 'hidden')
+        self.state = state
+
+        super(EventCategoryIndex, self).__init__(catalog, initial_index)
+
+        if initial_index is not None:
+            self.set_metadata('values', None)
+
+    @property
+    def name(self):
+        return 'categories-%s' % self.state
+
+    @staticmethod
+    def value(value):
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+
+        return value.strip()
+
+    def keys(self, event):
+        """ Returns the (category, value) keys of the given event (brain). """
+        keys = set()
+
+        for category, label, values in event.categories or ():
+            if isinstance(values, basestring):
+                values = (values, )
+
+            for value in values:
+                value = self.value(value)
+
+                if value:
+                    keys.add((category, value))
+
+        return keys
+
+    def reindex(self):
+
+        events = self.catalog.query(review_state=self.state)
+
+        if self.index or self.index is None:
+            self.index = OOBTree()
+
+        if self.get_metadata('values') or self.get_metadata('values') is None:
+            self.set_metadata('values', IOBTree())
+
+        self.update(events)
+
+    @property
+    def values(self):
+        """ Returns the reverse index, containing the keys of each event by
+        integer id. The reverse index is built from the index if it doesn't
+        exist yet.
+
+        """
+        values = self.get_metadata('values')
+
+        if values is None:
+            by_id = defaultdict(list)
+
+            for key, intids in (self.index or {}).items():
+                for intid in intids:
+                    by_id[intid].append(key)
+
+            values = IOBTree()
+
+            for intid, keys in by_id.iteritems():
+                values[intid] = tuple(sorted(keys))
+
+            self.set_metadata('values', values)
+
+        return values
+
+    def update(self, events, ids=None):
+        """ Updates the index with the given events (brains). The ids of
+        all events given and the additional ids (of events which have left
+        the state or were removed) are removed from the index first.
+
+        """
+        ids = set(ids or ())
+        ids.update(e.id for e in events)
+
+        managed = [e for e in events if e.review_state == self.state]
+        new = dict((e.id, self.keys(e)) for e in managed)
+
+        for id in ids:
+            self.replace(id, new.get(id, ()))
+
+    def remove(self, ids):
+        assert ids
+
+        for id in ids:
+            self.replace(id, ())
+
+    def replace(self, id, keys):
+        """ Replaces the keys of the event with the given id. """
+
+        if keys:
+            intid = self.ids.register(id)
+        else:
+            intid = self.ids.get(id)
+
+            if intid is None:
+                return
+
+        reverse = self.values
+
+        old = set(reverse.get(intid, ()))
+        new = set(keys)
+
+        if old == new:
+            return
+
+        index = self.index
+
+        for key in old - new:
+            index[key].remove(intid)
+
+            if not index[key]:
+                del index[key]
+
+        for key in new - old:
+            if key not in index:
+                index[key] = IITreeSet()
+
+            index[key].insert(intid)
+
+        if new:
+            reverse[intid] = tuple(sorted(new))
+        else:
+            del reverse[intid]
+
+    def match(self, term, operator='or'):
+        """ Returns the integer ids of the events matching the given term,
+        a dictionary of categories and values. Each category must match,
+        with any of the values (operator 'or') or all of them ('and').
+
+        Returns None if the term doesn't limit the events.
+
+        """
+        assert operator in ('or', 'and')
+
+        result = None
+
+        for category, values in term.items():
+
+            if not values or values == '!empty':
+                continue
+
+            if isinstance(values, basestring):
+                values = (values, )
+
+            matches = [
+                self.index.get((category, self.value(value)), IITreeSet())
+                for value in values
+            ]
+
+            if operator == 'or':
+                matched = multiunion(matches)
+            else:
+                matched = reduce(intersection, matches)
+
+            result = intersection(result, matched)
+
+        return result
+
+    def counts(self, categories, subset=None, occurrences=None):
+        """ Returns the number of events by value for each of the given
+        categories, limited to the given subset (brains or integer ids).
+
+        If the number of occurrences by integer id is given instead of the
+        subset, the occurrences of those events are counted.
+
+        """
+        counts = dict((category, dict()) for category in categories)
+
+        if occurrences is not None:
+            subset = IITreeSet(occurrences)
+        elif subset is not None:
+            subset = self.intids(subset)
 
-        return LazyList(get_item, len(subindex))
+        for (category, value), intids in self.index.items():
+            if category not in counts:
+                continue
+
+            if subset is None:
+                count = len(intids)
+            elif occurrences is None:
+                count = len(intersection(intids, subset))
+            else:
+                count = sum(
+                    occurrences[i] for i in intersection(intids, subset)
+                )
+
+            if count:
+                counts[category][value] = count
+
+        return counts
 
 
 class EventsDirectoryCatalog(DirectoryCatalog):
@@ -437,6 +954,9 @@ class EventsDirectoryCatalog(DirectoryCatalog):
 
     _lock = Lock()
 
+    # number of events resolved at once by the export
+    export_window = 100
+
     def __init__(self, *args, **kwargs):
         self._daterange = dates.default_daterange
         start, end = getattr(dates.DateRanges(), 'custom')
@@ -458,6 +978,9 @@ class EventsDirectoryCatalog(DirectoryCatalog):
             hidden=self.ix_hidden,
             archived=self.ix_archived
         )
+        self.category_indices = dict(
+            (state, EventCategoryIndex(self, state)) for state in self.indices
+        )
 
     def daterange_dates(self):
         if self._daterange == 'custom':
@@ -473,29 +996,104 @@ class EventsDirectoryCatalog(DirectoryCatalog):
         for ix in self.indices.values():
             ix.reindex()
 
+        for ix in self.category_indices.values():
+            ix.reindex()
+
+        # the integer ids of the events in none of the indices are released
+        events = self.query(review_state=self.indices.keys())
+        self.release(set(self.ix_published.ids.ids.keys()) - set(
+            e.id for e in events
+        ))
+
+        self.mark_modified()
+
+    @synchronized(_lock)
+    def update(self, ids):
+        """ Updates the indices for the items with the given ids only. Items
+        which no longer exist are removed from the indices.
+
+        """
+        if not ids:
+            return
+
+        events = self.query(review_state=self.indices.keys(), id=list(ids))
+
+        for state, ix in self.indices.items():
+            managed = [e for e in events if e.review_state == state]
+            ix.update(managed, ids)
+            self.category_indices[state].update(managed, ids)
+
+        self.release(set(ids) - set(e.id for e in events))
+
+        self.mark_modified()
+
+    def release(self, ids):
+        """ Releases the integer ids of the events with the given ids, which
+        were removed from all indices.
+
+        """
+        intids = self.ix_published.ids
+
+        for id in ids:
+            intids.release(id)
+
+    modified_key = 'seantis.dir.events.modified'
+
+    @property
+    def modified(self):
+        """ Returns the date (utc) the events of the directory last changed
+        or None if unknown. Exports derived from the events are valid as
+        long as this date stays the same.
+
+        """
+        return IAnnotations(self.directory).get(self.modified_key)
+
+    def mark_modified(self):
+        IAnnotations(self.directory)[self.modified_key] = \
+            datetime.utcnow().replace(tzinfo=utc)
+
     @property
     def submitted_count(self):
         """ Returns the submitted count depending on the current date filter
         but independent of the current state filter.
 
-        This needs to loop through all elements again so use only if needed.
+        The occurrences are counted in the index of the submitted events.
+        As only the events the user may publish are counted, the count is
+        cached by user and by their roles on the directory until the events
+        change.
         """
 
-        results = self.catalog(
-            path={'query': self.path, 'depth': 1},
-            object_provides=IEventsDirectoryItem.__identifier__,
-            review_state=('submitted', )
-        )
+        start, end = self.daterange_dates()
+        user = getSecurityManager().getUser()
+        roles = tuple(sorted(user.getRolesInContext(self.directory)))
+        key = (self.path, self.modified, start, end, user.getId(), roles)
+
+        with submitted_counts_lock:
+            submitted_count = submitted_counts.get(key)
+
+        if submitted_count is not None:
+            return submitted_count
+
+        counts = self.ix_submitted.counts(start, end)
+
+        if counts:
+            results = self.catalog(
+                path={'query': self.path, 'depth': 1},
+                object_provides=IEventsDirectoryItem.__identifier__,
+                review_state=('submitted', ),
+                id=counts.keys()
+            )
+        else:
+            results = []
 
         submitted_count = 0
 
-        items = []
         for item in results:
             if self.directory.allow_action('publish', item):
-                items.append(item)
+                submitted_count += counts[item.id]
 
-        for spawn in self.spawn(items):
-            submitted_count += 1
+        with submitted_counts_lock:
+            submitted_counts[key] = submitted_count
 
         return submitted_count
 
@@ -611,16 +1209,52 @@ class EventsDirectoryCatalog(DirectoryCatalog):
         if len(nonempty_terms) == 0:
             return self.items()
 
-        self.subset = super(EventsDirectoryCatalog, self).filter(term)
-        return sorted(
-            self.spawn(self.hide_blocked(self.subset)), key=self.sortkey()
+        # the events matching the term are looked up in the category index
+        # and the order index is limited to them
+        ix = self.category_indices[self.state]
+        subset = ix.match(term, operator='and')
+
+        if subset and (self.import_source != '' or self.state == 'submitted'):
+            brains = self.query(id=[ix.ids.name(intid) for intid in subset])
+            subset = ix.intids(self.hide_blocked(brains))
+
+        self.subset = subset
+        return self.lazy_list
+
+    def grouped_possible_values(self, items=None, categories=None):
+        """ Counts the occurrences in the date range by category value using
+        the category index, unless the items to count are given. The
+        occurrences returned by filter and search are counted without
+        resolving them.
+
+        """
+        if isinstance(items, LazyList):
+            # the lazy lists are limited to the subset
+            subset = self.subset
+        elif items:
+            return super(EventsDirectoryCatalog, self).grouped_possible_values(
+                items, categories
+            )
+        else:
+            subset = self.query() if self.import_source != '' else None
+
+        start, end = self.daterange_dates()
+        occurrences = self.indices[self.state].occurrences(start, end, subset)
+
+        return self.category_indices[self.state].counts(
+            categories or self.directory.all_categories(),
+            occurrences=occurrences
         )
 
     def search(self, text):
-        self.subset = super(EventsDirectoryCatalog, self).search(text)
-        return sorted(
-            self.spawn(self.hide_blocked(self.subset)), key=self.sortkey()
-        )
+        # only the occurrences of the found events which are shown are
+        # resolved, through the order index limited to those events
+        results = super(EventsDirectoryCatalog, self).search(text)
+
+        ix = self.indices[self.state]
+        self.subset = ix.intids(self.hide_blocked(results))
+
+        return self.lazy_list
 
     def limit_subset_to_source(self):
         if self.import_source != '' and self.subset is None:
@@ -641,6 +1275,9 @@ class EventsDirectoryCatalog(DirectoryCatalog):
             **kw
         )
 
+        ix = self.ix_published
+        subset = ix.intids(subset)
+
         if not imported:
             # Unfortunantely, we cannot query for 'not having an interface' nor
             # not having not the attribute 'source' - we have to build the
@@ -652,21 +1289,17 @@ class EventsDirectoryCatalog(DirectoryCatalog):
                 **kw
             )
             if len(external):
-                subset_ids = list(
-                    frozenset([brain.id for brain in subset]) -
-                    frozenset([brain.id for brain in external])
-                )
-                subset = [brain for brain in subset if brain.id in subset_ids]
+                subset = difference(subset, ix.intids(external))
 
         if term:
-            filter_key = partial(utils.terms_match, term=term)
-            subset = filter(filter_key, subset)
-
-        subset = sorted(subset, key=self.sortkey())
+            subset = intersection(
+                subset, self.category_indices['published'].match(term)
+            )
 
         # Get lazy list from indexer using the subset
         start, end = getattr(dates.DateRanges(), 'this_and_next_year')
-        ll = self.ix_published.lazy_list(start, end, subset)
+        ll = ix.lazy_list(start, end, subset)
+        ll.window = self.export_window
 
         # Check if upper limit is valid
         if not isinstance(max, (int, long)) or (max <= 0):
@@ -684,6 +1317,20 @@ class EventsDirectoryCatalog(DirectoryCatalog):
 
         return construct_icalendar(self.directory, items)
 
+    def ical(self, search=None, term=None):
+        """ Returns the serialized calendar, like calendar, but assembled from
+        the cached VEVENTs of the events.
+
+        """
+        if search:
+            items = super(EventsDirectoryCatalog, self).search(search)
+        elif term:
+            items = super(EventsDirectoryCatalog, self).filter(term)
+        else:
+            items = super(EventsDirectoryCatalog, self).items()
+
+        return calendars.assemble(self.directory, items)
+
     def import_sources(self):
         return self.catalog(
             object_provides=IExternalEventSource.__identifier__
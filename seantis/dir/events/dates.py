@@ -1,3 +1,4 @@
+import bisect
 import pytz
 
 from datetime import datetime, timedelta
@@ -68,6 +69,51 @@ def as_timezone(date, timezone):
     return timezone.normalize(date)
 
 
+def localize_sorted(timezone, dates):
+    """ Localizes the given sorted naive dates exactly like timezone.localize
+    would, which is slow as it probes the dates around each date.
+
+    The probes all end up in the same period of the timezone if the date is
+    not close to a transition. Those dates are therefore localized with the
+    timezone of the previous date, as long as the periods are known.
+
+    """
+    transitions = getattr(timezone, '_utc_transition_times', None)
+
+    if not transitions:
+        return [timezone.localize(date) for date in dates]
+
+    margin = timedelta(days=2)
+
+    result = []
+    tzinfo, safe_start, safe_end = None, None, None
+
+    for date in dates:
+        if tzinfo is not None and safe_start < date < safe_end:
+            result.append(date.replace(tzinfo=tzinfo))
+            continue
+
+        localized = timezone.localize(date)
+        result.append(localized)
+
+        ix = bisect.bisect_right(transitions, date)
+
+        if ix > 0:
+            safe_start = transitions[ix - 1] + margin
+
+            if ix < len(transitions):
+                safe_end = transitions[ix] - margin
+            else:
+                safe_end = datetime.max
+
+        if ix > 0 and safe_start < date < safe_end:
+            tzinfo = localized.tzinfo
+        else:
+            tzinfo = None
+
+    return result
+
+
 def as_rfc5545_string(datetime):
     """ Converts a datetime into the RFC5545 Datetime Form #2 as defined in
     http://tools.ietf.org/html/rfc5545#section-3.3.5
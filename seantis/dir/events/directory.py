@@ -4,14 +4,18 @@ from AccessControl import getSecurityManager
 from datetime import date
 from dateutil.parser import parse
 from five import grok
+from functools import partial
 from plone.protect import createToken
 from Products.CMFCore import permissions
+from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.PloneBatch import Batch
 from seantis.dir.base import directory
 from seantis.dir.base import session
 from seantis.dir.base.utils import cached_property, unicode_collate_sortkey
 from seantis.dir.events import _
+from seantis.dir.events import calendars
 from seantis.dir.events import dates
+from seantis.dir.events import recurrence
 from seantis.dir.events import utils
 from seantis.dir.events.interfaces import (
     IEventsDirectory,
@@ -116,6 +120,16 @@ class EventsDirectoryIndexView(grok.View, directory.DirectoryCatalogMixin):
             self.catalog.reindex()
 
         result = []
+
+        result.append('recurrence expansions')
+        result.append('---------------------')
+        result.append('')
+        result.append('cached: %i' % len(recurrence.expansions))
+        result.append('cached starts: %i' % recurrence.expansions.total)
+        result.append('hits: %i' % recurrence.expansions.hits)
+        result.append('misses: %i' % recurrence.expansions.misses)
+        result.append('')
+
         for name, index in self.catalog.indices.items():
 
             result.append(name)
@@ -123,20 +137,10 @@ class EventsDirectoryIndexView(grok.View, directory.DirectoryCatalogMixin):
             result.append('')
 
             for ix, identity in enumerate(index.index):
-                result.append('%i -> %s' % (ix, identity))
+                result.append('%i -> %s' % (ix, index.identity_repr(identity)))
 
             result.append('')
 
-            dateindex = index.get_metadata('dateindex')
-
-            if dateindex:
-                result.append('-> dateindex')
-
-                for d in sorted(dateindex):
-                    result.append('%s -> %s' % (
-                        d.strftime('%y.%m.%d'), dateindex[d])
-                    )
-
         return '\n'.join(result)
 
 
@@ -179,11 +183,13 @@ class EventsDirectoryView(directory.View):
 
     @property
     def filter_values(self):
-        values = self.catalog.possible_values()
+        values = self.catalog.grouped_possible_values(
+            categories=('cat1', 'cat2')
+        )
         return {
-            'cat1': sorted(set(values.get('cat1', [])),
+            'cat1': sorted(values.get('cat1', {}).keys(),
                            key=unicode_collate_sortkey()),
-            'cat2': sorted(set(values.get('cat2', [])),
+            'cat2': sorted(values.get('cat2', {}).keys(),
                            key=unicode_collate_sortkey()),
         }
 
@@ -332,6 +338,12 @@ class EventsDirectoryView(directory.View):
     def has_results(self):
         return len(self.batch) > 0
 
+    @property
+    def is_anonymous(self):
+        return getToolByName(
+            self.context, 'portal_membership'
+        ).isAnonymousUser()
+
     @property
     def show_import_sources(self):
         return getSecurityManager().checkPermission(
@@ -371,14 +383,43 @@ class EventsDirectoryView(directory.View):
         imported = 'imported' in self.request.keys()
 
         if self.is_ical_export:
-            calendar = self.catalog.calendar(search=search, term=term)
+            calendar = partial(self.catalog.ical, search=search, term=term)
+
+            # the feeds of anonymous users (i.e. calendar clients) only
+            # differ by query and change with the events
+            if self.is_anonymous:
+                key = (
+                    self.context.absolute_url(), self.catalog.modified,
+                    search, term and sorted(term.items())
+                )
+                calendar = calendars.cached_feed(key, calendar)
+            else:
+                calendar = calendar()
+
             return utils.render_ical_response(self.request, self.context,
                                               calendar)
 
         elif self.is_json_export:
-            export = self.catalog.export(search=search, term=term, max=max,
-                                         imported=imported)
-            return utils.render_json_response(self.request, export, compact)
+            export = partial(self.catalog.export, search=search, term=term,
+                             max=max, imported=imported)
+
+            # the export changes with the events and with the date, its
+            # urls with the host and scheme of the request
+            modified = self.catalog.modified
+            today = dates.default_now().replace(
+                hour=0, minute=0, second=0, microsecond=0
+            )
+            key = (
+                self.context.absolute_url(), modified, today.date(),
+                search, term and sorted(term.items()), max, compact, imported
+            )
+
+            if modified and modified < today:
+                modified = dates.to_utc(today)
+
+            return utils.render_cached_json_response(
+                self.request, key, modified, export, compact
+            )
 
         else:
             return self._template.render(self)
@@ -452,6 +493,10 @@ class EventsDirectoryView(directory.View):
         start = int(self.request.get('b_start') or 0)
         lazy_list = self.catalog.lazy_list
 
+        # the batch accesses the items one by one, resolve the whole page
+        # when the first item is accessed
+        lazy_list.window = directory.ITEMSPERPAGE
+
         # seantis.dir.events lazy list implementation currently cannot
         # deal with orphans.
         return Batch(lazy_list, directory.ITEMSPERPAGE, start, orphan=0)
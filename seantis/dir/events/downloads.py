@@ -0,0 +1,199 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from threading import Lock
+from urllib2 import urlopen, HTTPError, Request
+
+
+def conditional_download(url, validators=None, spool=False):
+    """ Downloads the given url. If the etag and last modified date of a
+    previous download are given, the server may answer that the data did
+    not change. Returns the data (None if not modified) and the etag and
+    last modified date of the response.
+
+    If spool is true, the data is returned as a temporary file instead of
+    a string, so large downloads are not held in memory.
+
+    """
+    etag, modified = validators or (None, None)
+
+    request = Request(url)
+    if etag:
+        request.add_header('If-None-Match', etag)
+    if modified:
+        request.add_header('If-Modified-Since', modified)
+
+    try:
+        response = urlopen(request, timeout=300)
+    except HTTPError as e:
+        if e.code == 304:
+            return None, validators
+        raise
+
+    headers = response.info()
+    validators = headers.get('ETag'), headers.get('Last-Modified')
+
+    if not spool:
+        return response.read(), validators
+
+    data = tempfile.TemporaryFile()
+    shutil.copyfileobj(response, data)
+    data.seek(0)
+
+    return data, validators
+
+
+class DownloadCache(object):
+    """ Keeps downloaded files on disk, so that images and attachments are
+    not downloaded again by each import run. The files are revalidated with
+    the server using their etag and last modified date.
+
+    The directory may be shared by several instances. If the files in it
+    exceed the given size, the least recently used files are removed.
+
+    """
+
+    def __init__(self, path, size=512 * 1024 * 1024):
+        self.path = path
+        self.size = size
+        self.lock = Lock()
+
+        # the size of the files, counted when pruning and kept up to date
+        # by the writes of this instance in between
+        self.total = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, url, extension):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.path, key + extension)
+
+    def read(self, url):
+        """ Returns the cached data and the validators of the given url or
+        None if the url is not cached.
+
+        """
+        try:
+            with open(self.filename(url, '.json')) as meta:
+                validators = tuple(json.load(meta)['validators'])
+
+            with open(self.filename(url, '.data'), 'rb') as data:
+                return data.read(), validators
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def write(self, url, data, validators):
+        try:
+            replaced = os.path.getsize(self.filename(url, '.data'))
+        except OSError:
+            replaced = 0
+
+        # files are written under a temporary name and renamed, as other
+        # threads and instances may read them at the same time
+        for extension, content in (
+            ('.data', data),
+            ('.json', json.dumps({'url': url, 'validators': validators}))
+        ):
+            handle, temporary = tempfile.mkstemp(dir=self.path)
+
+            with os.fdopen(handle, 'wb') as f:
+                f.write(content)
+
+            os.rename(temporary, self.filename(url, extension))
+
+        # the files are only listed if the cache may be full
+        with self.lock:
+            if self.total is not None:
+                self.total += len(data) - replaced
+
+            full = self.total is None or self.total > self.size
+
+        if full:
+            self.prune()
+
+    def touch(self, url):
+        try:
+            os.utime(self.filename(url, '.data'), None)
+        except OSError:
+            pass
+
+    def prune(self):
+        """ Removes the least recently used files until the cache fits. """
+        with self.lock:
+            files = []
+
+            for name in os.listdir(self.path):
+                if not name.endswith('.data'):
+                    continue
+
+                try:
+                    stat = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue
+
+                files.append((stat.st_mtime, stat.st_size, name[:-5]))
+
+            total = sum(size for mtime, size, key in files)
+
+            for mtime, size, key in sorted(files):
+                if total <= self.size:
+                    break
+
+                for extension in ('.json', '.data'):
+                    try:
+                        os.remove(os.path.join(self.path, key + extension))
+                    except OSError:
+                        pass
+
+                total -= size
+
+            self.total = total
+
+    def get(self, url):
+        """ Returns the data of the given url, from the cache if it did not
+        change on the server.
+
+        """
+        cached = self.read(url)
+
+        # without validators the server can't tell if the data changed
+        if cached and any(cached[1]):
+            data, validators = conditional_download(url, cached[1])
+
+            if data is None:
+                self.touch(url)
+                return cached[0]
+        else:
+            data, validators = conditional_download(url)
+
+        self.write(url, data, validators)
+
+        return data
+
+
+_cache = None
+_cache_lock = Lock()
+
+
+def cache():
+    """ Returns the download cache, whose directory may be set through the
+    seantis_events_download_cache environment variable.
+
+    """
+    global _cache
+
+    with _cache_lock:
+        if _cache is None:
+            _cache = DownloadCache(os.getenv(
+                'seantis_events_download_cache',
+                os.path.join(tempfile.gettempdir(), 'seantis.dir.events')
+            ))
+
+        return _cache
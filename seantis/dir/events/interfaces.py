@@ -460,13 +460,34 @@ class IExternalEventCollector(Interface):
         externally.
         """)
 
-    def fetch(self):
+    def fetch(self, data=None, parsed=None):
         """Generator function returning all items to import. If returning an
         empty array, all already imported events will be deleted if autoremove
         is set. To prevent importing anything, throw a NoImportDataException.
 
+        The items are created from the given parse result, the parsed data
+        or the data downloaded from the source (in this order).
+
         """
 
+    def build_url(self):
+        """Optional. Returns the url the data of the source is downloaded
+        from. Together with parse, this allows the importer to download the
+        sources in parallel.
+
+        """
+
+    def parse(self, data):
+        """Optional. Parses the downloaded data for fetch. Called outside
+        of the ZODB thread, so it must not access the source object.
+
+        """
+
+    streaming = Attribute("""
+        Optional. If true, parse is given the downloaded data as a file
+        instead of a string, as the data is too large to be held in memory.
+        """)
+
 
 class ISourceCondition(Interface):
     """Interface for the configurable aspects of a source condition of a
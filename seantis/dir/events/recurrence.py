@@ -1,18 +1,36 @@
 import pytz
+import re
 
 from itertools import groupby
 from collections import OrderedDict
 from datetime import datetime, timedelta
+from threading import Lock
 
 from zope.proxy import ProxyBase
 from urllib import urlencode
 
+from plone.event import recurrence as event_recurrence
 from plone.event.recurrence import recurrence_sequence_ical
 from plone.event.utils import utcoffset_normalize, DSTADJUST
 
 from seantis.dir.events import dates
+from seantis.dir.events import utils
 from seantis.dir.events.dates import overlaps
 
+# the starts of the occurrences expanded from recurrence rules, shared by
+# all threads - the keys consist of all the input of the expansion, so an
+# item which changed simply doesn't find its old entries anymore. The cache
+# is limited by the number of starts, as the windows vary in length
+expansions = utils.LRUCache(100000, weight=lambda starts: len(starts) + 1)
+expansions_lock = Lock()
+
+# plone.event stops after this many occurrences in the requested window
+MAXCOUNT = getattr(event_recurrence, 'MAXCOUNT', None)
+
+simple_until = re.compile(
+    r'^(\d{4})(\d{2})(\d{2})(?:T(\d{2})(\d{2})(\d{2})?)?Z?$'
+)
+
 
 class Occurrence(ProxyBase):
 
@@ -245,6 +263,192 @@ def occurrences_over_limit(rule, start, limit):
     return False
 
 
+def simple_rule(rule, start):
+    """ Parses recurrence rules of the form FREQ=DAILY|WEEKLY with optional
+    BYDAY and UNTIL parts, as created by the submission form and the guidle
+    import. Returns the weekdays (0 - 6) and the naive local until date
+    (or None) of the rule.
+
+    Returns None for any other rule, including the ones plone.event would
+    not interpret as plain dateutil rules.
+
+    """
+    if not rule.startswith('RRULE:') or '\n' in rule.strip():
+        return None
+
+    parts = {}
+    for part in rule.strip()[len('RRULE:'):].split(';'):
+        key, sep, value = part.partition('=')
+
+        if not sep or key in parts:
+            return None
+
+        parts[key.upper()] = value.upper()
+
+    freq = parts.pop('FREQ', None)
+
+    if freq not in ('DAILY', 'WEEKLY'):
+        return None
+
+    if parts.pop('INTERVAL', '1') != '1':
+        return None
+
+    parts.pop('WKST', None)
+
+    byday = parts.pop('BYDAY', None)
+
+    if byday is not None:
+        try:
+            weekdays = set(dates.weekdays[d] for d in byday.split(','))
+        except KeyError:
+            return None
+    elif freq == 'DAILY':
+        weekdays = set(xrange(7))
+    else:
+        weekdays = set((start.weekday(), ))
+
+    until = parts.pop('UNTIL', None)
+
+    if parts:
+        return None
+
+    if until is not None:
+        match = simple_until.match(until)
+
+        if not match:
+            return None
+
+        year, month, day, hour, minute, second = match.groups()
+
+        # plone.event moves untils at 00:00:00 to the time of the start
+        # (or to the end of the day if the start is at 00:00:00)
+        if (hour, minute, second) == ('00', '00', '00'):
+            if start.time() != datetime.min.time():
+                return None
+
+            hour, minute, second = '23', '59', '59'
+
+        until = datetime(*(
+            int(v or 0) for v in (year, month, day, hour, minute, second)
+        ))
+
+    return weekdays, until
+
+
+def simple_sequence(rule, start, from_, until):
+    """ Returns the starts of the occurrences of simple rules (see
+    simple_rule) between from and until, computed directly from the day
+    numbers instead of iterating through all occurrences since the start
+    of the rule. Yields the same results as recurrence_sequence_ical.
+
+    Returns None if the rule is not simple.
+
+    """
+    if not all((from_, until, from_.tzinfo, until.tzinfo)):
+        return None
+
+    # plone.event works with a resolution of seconds
+    start, from_, until = (
+        d.replace(microsecond=0) for d in (start, from_, until)
+    )
+
+    parsed = simple_rule(rule, start)
+
+    if parsed is None:
+        return None
+
+    weekdays, rule_until = parsed
+
+    tz = start.tzinfo
+    time = start.time().replace(tzinfo=None)
+
+    wall = start.replace(tzinfo=None)
+    lower = from_.replace(tzinfo=None)
+    upper = until.replace(tzinfo=None)
+
+    # the start is always part of the sequence
+    walls = set()
+
+    if lower <= wall <= upper:
+        walls.add(wall)
+
+    last = rule_until and min(upper, rule_until) or upper
+    first_day = max(wall.date(), lower.date())
+
+    first = first_day.toordinal()
+    stop = last.date().toordinal() + 1
+
+    for weekday in weekdays:
+        offset = (weekday - first_day.weekday()) % 7
+
+        for ordinal in xrange(first + offset, stop, 7):
+            day = datetime.fromordinal(ordinal).date()
+            occurrence = datetime.combine(day, time)
+
+            if wall <= occurrence and lower <= occurrence <= last:
+                walls.add(occurrence)
+
+    walls = sorted(walls)
+
+    if MAXCOUNT:
+        walls = walls[:MAXCOUNT]
+
+    result = []
+
+    # timezone aware dates are compared in utc
+    for occurrence in dates.localize_sorted(tz, walls):
+
+        if occurrence < from_:
+            continue
+
+        if occurrence > until:
+            break
+
+        result.append(occurrence)
+
+    return result
+
+
+def sequence(rule, start, from_, until):
+    """ Returns the starts of the occurrences of the given recurrence rule
+    between from and until, using the arithmetic for simple rules and the
+    recurrence rule iterator of plone.event for all others.
+
+    """
+    starts = simple_sequence(rule, start, from_, until)
+
+    if starts is None:
+        starts = recurrence_sequence_ical(
+            start=start, recrule=rule, from_=from_, until=until
+        )
+
+    return starts
+
+
+def expand(rule, start, min_date, max_date):
+    """ Returns the starts of the occurrences of the given recurrence rule
+    between min and max date, normalized to the timezone of the start.
+
+    The results are cached in a bounded cache shared by the process.
+
+    """
+    key = (rule, start, start.tzinfo.zone, min_date, max_date)
+
+    with expansions_lock:
+        starts = expansions.get(key)
+
+    if starts is None:
+        starts = tuple(
+            utcoffset_normalize(s, dstmode=DSTADJUST)
+            for s in sequence(rule, start, min_date, max_date)
+        )
+
+        with expansions_lock:
+            expansions[key] = starts
+
+    return starts
+
+
 def occurrences(item, min_date, max_date):
     """ Returns the occurrences for item between min and max date.
     Will return a list with a single item if the given item has no recurrence.
@@ -271,18 +475,10 @@ def occurrences(item, min_date, max_date):
     tz = pytz.timezone(item.timezone)
     local_start = tz.normalize(item_start)
 
-    _occurrences = recurrence_sequence_ical(
-        start=local_start,
-        recrule=item.recurrence,
-        from_=min_date,
-        until=max_date
-    )
-
     result = []
     duration = item_end - item_start
 
-    for start in _occurrences:
-        start = utcoffset_normalize(start, dstmode=DSTADJUST)
+    for start in expand(item.recurrence, local_start, min_date, max_date):
         result.append(Occurrence(item, start, start + duration))
 
     return result
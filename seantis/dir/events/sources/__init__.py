@@ -7,11 +7,17 @@ import os
 import pytz
 import transaction
 
-from collective.geo.geographer.interfaces import IWriteGeoreferenced
+from BTrees.OOBTree import OOBTree
+from collections import defaultdict, deque
+from collective.geo.geographer.interfaces import (
+    IGeoreferenced,
+    IWriteGeoreferenced
+)
 from datetime import datetime, timedelta
 from five import grok
 from functools32 import lru_cache
-from itertools import groupby
+from itertools import groupby, islice, izip_longest
+from multiprocessing.pool import ThreadPool
 from plone.dexterity.utils import createContentInContainer
 from plone.namedfile import NamedFile, NamedImage
 from plone.protect import createToken
@@ -23,6 +29,7 @@ from seantis.dir.base.interfaces import (
     IDirectoryCatalog,
     IDirectoryCategorized
 )
+from seantis.dir.events.downloads import cache, conditional_download
 from seantis.dir.events.interfaces import (
     IExternalEvent,
     IExternalEventCollector,
@@ -31,16 +38,158 @@ from seantis.dir.events.interfaces import (
     NoImportDataException
 )
 from seantis.plonetools import unrestricted
-from threading import Lock
-from urllib2 import urlopen, HTTPError
+from threading import BoundedSemaphore, Lock
+from timeit import default_timer
+from urllib2 import HTTPError
+from urlparse import urlparse
 from zope.annotation.interfaces import IAnnotations
+from zope.event import notify
 from zope.interface import alsoProvides
+from zope.lifecycleevent import ObjectModifiedEvent
+
+
+validators_key = 'seantis.dir.events.validators'
+
+
+def get_validators(source, url):
+    """ Returns the etag and last modified date of the last download of the
+    given source object, or None if the source was not downloaded from the
+    given url.
+
+    """
+    stored = IAnnotations(source).get(validators_key)
+
+    if stored and stored[0] == url:
+        return stored[1]
+
+    return None
+
+
+def set_validators(source, url, validators):
+    annotations = IAnnotations(source)
+
+    if annotations.get(validators_key) != (url, validators):
+        annotations[validators_key] = (url, validators)
+
+
+def prefetch(url, parse, validators=None, spool=False):
+    """ Downloads and parses the data of a source. Runs in a worker thread
+    and therefore must not touch the ZODB. If spool is true, the data is
+    downloaded into a temporary file which is passed to parse.
+
+    Returns the parse result (None if the source could not be read), the
+    seconds it took, the validators to use for the next download and
+    whether the data was modified at all.
+
+    """
+    start = default_timer()
+
+    try:
+        data, validators = conditional_download(url, validators, spool)
+
+        if data is None:
+            return None, default_timer() - start, validators, False
+
+        parsed = parse(data)
+    except:
+        log.exception('could not download %s' % url)
+        parsed, validators = None, None
+
+    return parsed, default_timer() - start, validators, True
+
+
+def prefetched(collector, result):
+    """ Returns the fetch function for the given prefetch result. """
+
+    def fetch():
+        parsed = result.get()[0]
+
+        if parsed is None:
+            raise NoImportDataException()
+
+        return collector.fetch(parsed=parsed)
+
+    return fetch
+
+
+# image and attachments are downloaded
+download_types = {
+    'image': NamedImage,
+    'attachment_1': NamedFile,
+    'attachment_2': NamedFile
+}
+
+
+def allow_download(download, url):
+
+    if download != 'image':
+        return True
+
+    # whitelist the images that are known to work
+    # not working is *.bmp. We could convert but I'd rather
+    # force people to use a sane format
+    return url.lower().endswith((
+        'png', 'jpg', 'jpeg', '@@images/image'
+    ))
+
+
+def prefetch_download(url, semaphore):
+    """ Downloads the given url into the download cache. Runs in a worker
+    thread, holding the given semaphore of the host.
+
+    """
+    with semaphore:
+        try:
+            cache().get(url)
+        except Exception as e:
+            log.warn('could not download %s: %s' % (url, e))
+            return False
+
+    return True
+
+
+def fingerprint(events):
+    """ Returns a hash of the content of the given events (of the same
+    source_id), which unlike last_update only changes if the events do.
+
+    """
+    ignored = ('fetch_id', 'last_update', 'source')
+    normalized = []
+
+    for event in events:
+        items = []
+
+        for key, value in sorted(event.items()):
+            if key in ignored:
+                continue
+
+            if isinstance(value, (set, frozenset)):
+                value = sorted(value)
+
+            items.append((key, value))
+
+        normalized.append(repr(items))
+
+    return hashlib.sha1('\n'.join(sorted(normalized))).hexdigest()
 
 
 class ExternalEventImporter(object):
 
-    def __init__(self, context):
+    # the number of files downloaded at the same time, in total and per host
+    download_threads = 8
+    downloads_per_host = 2
+
+    def __init__(self, context, defer_reindex=False):
         self.context = context
+        self.downloaded = set()
+
+        # the created events, indexed by fetch_one or, if deferred, by
+        # an explicit call to reindex
+        self.defer_reindex = defer_reindex
+        self.reindex_queue = {}
+
+        # False if the last fetch_one received no data or stopped at the limit
+        self.complete = False
 
     def sources(self):
         result = []
@@ -53,9 +202,154 @@ class ExternalEventImporter(object):
 
         return result
 
+    def updates(self, events, existing):
+        """ Returns the existing events which may be updated in place by
+        the given events, by id of the event dict.
+
+        Only the events of a source_id whose number of events did not change
+        are updated in place. The events are paired by start date.
+
+        """
+        incoming = defaultdict(list)
+        for event in events:
+            incoming[event['source_id']].append(event)
+
+        updates = {}
+        for source_id, ids in existing.items():
+            if len(incoming.get(source_id, ())) != len(ids):
+                continue
+
+            pairs = zip(
+                sorted(incoming[source_id], key=lambda e: e['start']),
+                sorted(map(self.context.get, ids), key=lambda o: o.start)
+            )
+
+            for event, obj in pairs:
+                updates[id(event)] = obj
+
+        return updates
+
+    def update_event(self, obj, event, coordinates, categories):
+        """ Updates the attributes of the given imported event which differ
+        from the given event dict. Returns True if the event was changed.
+
+        """
+        changed = False
+        timezone = pytz.timezone(event['timezone'])
+
+        for key, value in event.items():
+
+            # the id is only a suggestion on creation
+            if key == 'id':
+                continue
+
+            current = getattr(obj, key, None)
+
+            # the dates are stored in utc by plone.app.event
+            if key in ('start', 'end') and current is not None:
+                if value.tzinfo:
+                    value = value.astimezone(timezone).replace(tzinfo=None)
+
+                current = current.astimezone(timezone).replace(tzinfo=None)
+
+                if event.get('whole_day'):
+                    if current.date() == value.date():
+                        continue
+                elif current == value.replace(microsecond=0):
+                    continue
+
+            elif current == value:
+                continue
+
+            setattr(obj, key, value)
+
+            # the bookkeeping of the import does not change the event
+            if key not in ('fetch_id', 'last_update', 'download_hashes'):
+                changed = True
+
+        geo = IGeoreferenced(obj)
+        if coordinates:
+            if geo.type != 'Point' or list(geo.coordinates) != coordinates:
+                IWriteGeoreferenced(obj).setGeoInterface('Point', coordinates)
+                changed = True
+        elif geo.type:
+            IWriteGeoreferenced(obj).removeGeoInterface()
+            changed = True
+
+        categorized = IDirectoryCategorized(obj)
+        for cat, values in zip(('cat1', 'cat2'), categories):
+            if set(getattr(categorized, cat) or ()) != values:
+                setattr(categorized, cat, list(values))
+                changed = True
+
+        if changed:
+            obj.notifyModified()
+            notify(ObjectModifiedEvent(obj))
+
+        return changed
+
+    def downloaded_files(self, events):
+        """ Returns the downloaded files of the given imported events by
+        the hash of their content.
+
+        """
+        files = {}
+
+        for event in events:
+            hashes = getattr(event, 'download_hashes', None) or {}
+
+            for download, digest in hashes.items():
+                if getattr(event, download, None) is not None:
+                    files[digest] = getattr(event, download)
+
+        return files
+
+    def prefetch_downloads(self, urls):
+        """ Downloads the given urls into the download cache in a pool of
+        worker threads, so that the events can be created without waiting
+        for the network.
+
+        """
+        hosts = defaultdict(list)
+        for url in set(urls) - self.downloaded:
+            hosts[urlparse(url).netloc].append(url)
+
+        if not hosts:
+            return
+
+        semaphores = dict(
+            (host, BoundedSemaphore(self.downloads_per_host))
+            for host in hosts
+        )
+
+        # alternate the hosts, so the workers don't wait for the same one
+        queue = [
+            (url, semaphores[host])
+            for group in izip_longest(*hosts.values())
+            for host, url in zip(hosts.keys(), group) if url
+        ]
+
+        pool = ThreadPool(min(self.download_threads, len(queue)))
+
+        try:
+            results = pool.map(lambda args: prefetch_download(*args), queue)
+        finally:
+            pool.terminate()
+
+        for (url, semaphore), success in zip(queue, results):
+            if success:
+                self.downloaded.add(url)
+
     @lru_cache(maxsize=50)
     def download(self, url):
-        return urlopen(url, timeout=300).read()
+        # prefetched files are read from the cache without revalidation
+        if url in self.downloaded:
+            cached = cache().read(url)
+
+            if cached is not None:
+                return cached[0]
+
+        return cache().get(url)
 
     def disable_indexing(self):
         self.context._v_fetching = True
@@ -84,6 +378,18 @@ class ExternalEventImporter(object):
         annotations = IAnnotations(self.context)
         annotations[self.annotation_key] = isodate.datetime_isoformat(dt)
 
+    def get_fingerprints(self):
+        """ Returns the fingerprints of the imported events by source_id. """
+        assert self.annotation_key
+
+        key = self.annotation_key + '.fingerprints'
+        annotations = IAnnotations(self.context)
+
+        if key not in annotations:
+            annotations[key] = OOBTree()
+
+        return annotations[key]
+
     def grouped_existing_events(self, source):
         events = {}
         if not source:
@@ -107,6 +413,8 @@ class ExternalEventImporter(object):
         imported = []
         len_deleted = 0
 
+        self.complete = False
+
         try:
             events = sorted(
                 function(),
@@ -116,6 +424,8 @@ class ExternalEventImporter(object):
             log.info('no data received for %s' % source)
             return imported, len_deleted
 
+        self.complete = True
+
         existing = self.grouped_existing_events(source)
 
         # Autoremove externally deleted events
@@ -123,8 +433,9 @@ class ExternalEventImporter(object):
             new_ids = [event['source_id'] for event in events]
             old_ids = existing.keys()
             delta = list(set(old_ids) - set(new_ids))
-            if limit is not None:
+            if limit is not None and len(delta) > limit:
                 delta = delta[:limit]
+                self.complete = False
             for source_id in delta:
                 # source id's are not necessarily unique
                 for event_id in existing[source_id]:
@@ -156,6 +467,18 @@ class ExternalEventImporter(object):
             # log.info('importing updates since {}'.format(last_update))
             changed_offers_only = True
 
+        # unchanged events are skipped by the fingerprint of their content,
+        # as not all sources provide a meaningful last_update
+        grouped = defaultdict(list)
+        for event in events:
+            grouped[event['source_id']].append(event)
+
+        fingerprints = self.get_fingerprints()
+        incoming = dict(
+            (source_id, fingerprint(items))
+            for source_id, items in grouped.items()
+        )
+
         total = len(events) if not limit else limit
 
         workflowTool = getToolByName(self.context, 'portal_workflow')
@@ -164,9 +487,63 @@ class ExternalEventImporter(object):
 
         limit_reached_id = None
 
+        # a reimport recreates all events
+        updates = {} if reimport else self.updates(events, existing)
+
+        def is_unchanged(event):
+            if event['source_id'] not in existing:
+                return False
+
+            if changed_offers_only:
+                if event['last_update'] <= last_update:
+                    return True
+
+            if not reimport:
+                known = fingerprints.get(event['source_id'])
+                if known == incoming[event['source_id']]:
+                    return True
+
+            return False
+
+        # the files of the events to import are downloaded up front, up to
+        # the limit reached by the import below
+        urls = []
+        count = 0
+        prefetch_limit_id = None
+        for event in events:
+            if prefetch_limit_id and prefetch_limit_id != event['source_id']:
+                break
+
+            if source_ids and event['source_id'] not in source_ids:
+                continue
+
+            if is_unchanged(event):
+                continue
+
+            count += 1
+            if limit and count >= limit and not prefetch_limit_id:
+                prefetch_limit_id = event['source_id']
+
+            for download in download_types:
+                url = event.get(download)
+
+                if url and allow_download(download, url):
+                    urls.append(url)
+
+        self.prefetch_downloads(urls)
+
+        # the number of processed events by source_id, the fingerprints are
+        # only stored for the source_ids whose events were all processed
+        processed = defaultdict(int)
+
+        # the limit counts the events to import, updated or not, like the
+        # prefetch above
+        count = 0
+
         for ix, event in enumerate(events):
 
             if limit_reached_id and limit_reached_id != event['source_id']:
+                self.complete = False
                 break
 
             if source_ids and event['source_id'] not in source_ids:
@@ -181,9 +558,10 @@ class ExternalEventImporter(object):
             if last_update_in_run < event['last_update']:
                 last_update_in_run = event['last_update']
 
-            if changed_offers_only and event['source_id'] in existing:
-                if event['last_update'] <= last_update:
-                    continue
+            if is_unchanged(event):
+                continue
+
+            count += 1
 
             # keep a set of all categories for the suggestions
             for cat in categories:
@@ -192,7 +570,7 @@ class ExternalEventImporter(object):
                 categories[cat] |= event[cat]
 
             # stop at limit
-            if limit and (len(imported) + 1) >= limit and not limit_reached_id:
+            if limit and count >= limit and not limit_reached_id:
                 log.info('reached limit of %i events' % limit)
                 # don't quit right away, all events of the same source_id
                 # need to be imported first since they have the same
@@ -204,48 +582,46 @@ class ExternalEventImporter(object):
                 transaction.savepoint(True)
 
             log.info('importing %i/%i %s @ %s' % (
-                (len(imported) + 1), total, event['title'],
+                count, total, event['title'],
                 event['start'].strftime('%d.%m.%Y %H:%M')
             ))
 
             event['source'] = source
+            processed[event['source_id']] += 1
+
+            # existing events are updated in place if possible, keeping
+            # their workflow state, uid and files
+            target = updates.get(id(event))
+
+            # the files of the previous events are reused if unchanged
+            if target is not None:
+                previous = self.downloaded_files([target])
+            else:
+                previous = self.downloaded_files(
+                    map(self.context.get, existing.get(event['source_id'], ()))
+                )
 
             # If the existing event has been hidden, we keep it hidden
             hide_event = False
-            if event['source_id'] in existing:
+            if target is None and event['source_id'] in existing:
                 for event_id in existing[event['source_id']]:
                     review_state = self.context.get(event_id).review_state
                     hide_event |= review_state == 'hidden'
 
             # source id's are not necessarily unique as a single external
             # event might have to be represented as more than one event in
-            # seantis.dir.events - therefore updating is done through
-            # deleting first, adding second
-            if event['source_id'] in existing:
+            # seantis.dir.events - therefore if the number of events of
+            # a source id changes, updating is done through deleting first,
+            # adding second
+            if target is None and event['source_id'] in existing:
                 for event_id in existing[event['source_id']]:
                     self.context.manage_delObjects(event_id)
                 del existing[event['source_id']]
 
             # image and attachments are downloaded
-            downloads = {
-                'image': NamedImage,
-                'attachment_1': NamedFile,
-                'attachment_2': NamedFile
-            }
-
-            def allow_download(download, url):
-
-                if download != 'image':
-                    return True
-
-                # whitelist the images that are known to work
-                # not working is *.bmp. We could convert but I'd rather
-                # force people to use a sane format
-                return url.lower().endswith((
-                    'png', 'jpg', 'jpeg', '@@images/image'
-                ))
+            event['download_hashes'] = {}
 
-            for download, method in downloads.items():
+            for download, method in download_types.items():
                 url = event.get(download)
                 name = download + '_name'
 
@@ -253,11 +629,30 @@ class ExternalEventImporter(object):
                     event[download] = None
                 else:
                     try:
-                        event[download] = method(self.download(url))
-                        if name in event:
-                            event[download].filename = event[name]
+                        data = self.download(url)
                     except HTTPError:
+                        data = None
+
+                    if data is None:
                         event[download] = None
+                    else:
+                        digest = hashlib.sha1(data).hexdigest()
+                        event['download_hashes'][download] = digest
+
+                        filename = event.get(name)
+                        reused = previous.get(digest)
+
+                        # the previous files may be shared by several events
+                        # and are therefore not renamed, but copied
+                        if reused is not None and (
+                            not filename or reused.filename == filename
+                        ):
+                            event[download] = reused
+                        else:
+                            event[download] = method(data)
+
+                            if filename:
+                                event[download].filename = filename
 
                 if name in event:
                     del event[name]
@@ -278,6 +673,18 @@ class ExternalEventImporter(object):
                 unsupported categories
             """
 
+            if target is not None:
+                try:
+                    coordinates = lat and lon and map(float, (lon, lat))
+                except ValueError:
+                    coordinates = None
+
+                # unchanged events are not counted, nor indexed again
+                if self.update_event(target, event, coordinates, cats):
+                    imported.append(target)
+
+                continue
+
             obj = createContentInContainer(
                 self.context, 'seantis.dir.events.item',
                 checkConstraints=False,
@@ -300,7 +707,7 @@ class ExternalEventImporter(object):
             workflowTool.doActionFor(obj, 'submit')
             workflowTool.doActionFor(obj, 'publish')
 
-            for download in downloads:
+            for download in download_types:
                 getattr(obj, download)
 
             alsoProvides(obj, IExternalEvent)
@@ -308,10 +715,22 @@ class ExternalEventImporter(object):
             if hide_event:
                 workflowTool.doActionFor(obj, 'hide')
 
+            # events updated in place are indexed through their modified
+            # event, created events once their data is complete
+            self.reindex_queue[obj.id] = obj
             imported.append(obj)
 
         self.set_last_update_time(last_update_in_run)
 
+        for source_id, count in processed.items():
+            if count == len(grouped[source_id]):
+                fingerprints[source_id] = incoming[source_id]
+
+        # forget the fingerprints of events no longer in the source
+        for source_id in list(fingerprints.keys()):
+            if source_id not in incoming:
+                del fingerprints[source_id]
+
         # add categories to suggestions
         for category in categories:
             key = '%s_suggestions' % category
@@ -330,6 +749,24 @@ class ExternalEventImporter(object):
 
         return imported, len_deleted
 
+    def reindex(self):
+        """ Indexes the created events in one pass, followed by the
+        directory and its catalog.
+
+        """
+        queue, self.reindex_queue = self.reindex_queue, {}
+
+        for id in queue:
+            # the event may have been removed in the meantime
+            event = self.context.get(id)
+
+            if event is not None:
+                event.reindexObject()
+
+        self.context.reindexObject()
+
+        IDirectoryCatalog(self.context).reindex()
+
     def fetch_one(
         self, source, function, limit=None, reimport=False, source_ids=[],
         autoremove=False
@@ -351,14 +788,9 @@ class ExternalEventImporter(object):
 
         if len(imported):
             # Reindex
-            log.info('reindexing commited events for %s' % source)
-
-            for event in imported:
-                event.reindexObject()
-
-            self.context.reindexObject()
-
-            IDirectoryCatalog(self.context).reindex()
+            if not self.defer_reindex:
+                log.info('reindexing commited events for %s' % source)
+                self.reindex()
 
             # Log runtime
             minutes = runtime.total_seconds() // 60
@@ -374,9 +806,13 @@ class ExternalEventImportScheduler(object):
 
     _lock = Lock()
 
+    # the number of sources downloaded at the same time
+    fetch_threads = 4
+
     def __init__(self):
         self.running = {}
         self.last_run = {}
+        self.timings = {}
 
     def is_importing_instance(self):
         """ Check if we are the instance which imports events.
@@ -434,26 +870,95 @@ class ExternalEventImportScheduler(object):
 
         log.info('begin importing sources from %s' % (import_directory))
 
+        timings = self.timings[import_directory] = []
+        pool = ThreadPool(self.fetch_threads)
+
+        importer = ExternalEventImporter(context, defer_reindex=True)
+
         try:
-            importer = ExternalEventImporter(context)
             sources = importer.sources()
             if not no_shuffle:
                 shuffle(sources)
-            for source in sources:
+
+            def submit(source):
+                collector = IExternalEventCollector(source.getObject())
+
+                if not hasattr(collector, 'parse'):
+                    return source, collector.fetch, None, None
+
+                # unchanged sources are only skipped on regular runs
+                url = collector.build_url()
+
+                if reimport or source_ids:
+                    validators = None
+                else:
+                    validators = get_validators(source.getObject(), url)
+
+                result = pool.apply_async(prefetch, (
+                    url, collector.parse, validators,
+                    getattr(collector, 'streaming', False)
+                ))
+                return source, prefetched(collector, result), result, url
+
+            # the sources are downloaded and parsed in the pool while the
+            # events are created one source after the other - only about
+            # as many sources as there are threads are held in advance, as
+            # each one keeps its parsed feed in memory until it's imported
+            sources = iter(sources)
+            jobs = deque(
+                submit(s) for s in islice(sources, self.fetch_threads)
+            )
+
+            while jobs:
+                source, fetch, result, url = jobs.popleft()
+
+                for next_source in islice(sources, 1):
+                    jobs.append(submit(next_source))
+
                 len_sources += 1
                 path = source.getPath()
+
+                # the download is not part of the import time
+                if result is not None:
+                    download, validators, modified = result.get()[1:]
+                else:
+                    download, validators, modified = 0.0, None, True
+
+                if not modified:
+                    log.info('source %s not modified' % (path))
+                    timings.append((path, download, 0.0, 0, 0))
+                    continue
+
+                start = default_timer()
                 events, deleted = importer.fetch_one(
                     path,
-                    IExternalEventCollector(source.getObject()).fetch,
+                    fetch,
                     source.getObject().limit,
                     reimport, source_ids,
                     source.getObject().autoremove)
                 log.info('source %s processed' % (path))
                 len_imported += events
                 len_deleted += deleted
+
+                # the parsed feed is not needed any longer
+                del fetch, result
+
+                # the validators are only kept once everything downloaded
+                # was imported, otherwise the rest would never be imported
+                if validators is not None:
+                    if importer.complete and not source_ids:
+                        set_validators(source.getObject(), url, validators)
+
+                timings.append((
+                    path, download, default_timer() - start, events, deleted
+                ))
         finally:
-            context.reindexObject()
-            IDirectoryCatalog(context).reindex()
+            pool.terminate()
+
+            # the events and the directory are indexed once for all sources
+            log.info('reindexing events of %s' % (import_directory))
+            importer.reindex()
+
             self.handle_run(import_directory, do_stop=True)
 
         return len_imported, len_deleted, len_sources
@@ -488,9 +993,18 @@ class EventsDirectoryFetchView(grok.View, directory.DirectoryCatalogMixin):
                     no_shuffle
                 )
 
-            return u'%i events imported from %i sources (%i deleted)' % (
+            lines = [u'%i events imported from %i sources (%i deleted)' % (
                 imported, sources, deleted
-            )
+            )]
+
+            path = '/'.join(self.context.getPhysicalPath())
+            for timing in import_scheduler.timings.get(path, []):
+                lines.append(
+                    u'%s: %.2fs download, %.2fs import, '
+                    u'%i imported, %i deleted' % timing
+                )
+
+            return u'\n'.join(lines)
 
         else:
             return u''
@@ -3,8 +3,9 @@ import string
 from datetime import timedelta
 from dateutil.parser import parse
 from five import grok
+from io import BytesIO
 from logging import getLogger
-from lxml import objectify
+from lxml import etree, objectify
 from seantis.dir.events.interfaces import (
     IExternalEventCollector,
     IExternalEventSourceGuidle,
@@ -37,6 +38,9 @@ class EventsSourceGuidle(grok.Adapter):
     grok.context(IExternalEventSourceGuidle)
     grok.provides(IExternalEventCollector)
 
+    # the exports are parsed from the downloaded file while importing
+    streaming = True
+
     def generate_recurrence(self, date):
         try:
             weekdays = list(date.weekdays.iterchildren())
@@ -151,18 +155,54 @@ class EventsSourceGuidle(grok.Adapter):
                 else:
                     event[key] = getattr(node, child).text
 
-    def fetch(self, xml=None):
+    def build_url(self):
+        return self.context.url
+
+    def parse(self, xml):
+        return self.offers(xml)
+
+    def offers(self, xml):
+        """ Yields the offers of the guidle export (a string or a file-like
+        object, which is closed at the end) one by one. The exports are
+        large, so instead of building the whole tree each offer is discarded
+        once it has been processed.
+
+        """
+        if isinstance(xml, basestring):
+            xml = BytesIO(xml)
+
+        offers = etree.iterparse(
+            xml, events=('end', ),
+            tag='{http://www.guidle.com}offer', remove_blank_text=True
+        )
+        offers.set_element_class_lookup(
+            objectify.ObjectifyElementClassLookup()
+        )
+
         try:
-            if xml is None:
-                xml = urlopen(self.context.url, timeout=300).read()
-            root = objectify.fromstring(xml)
+            for action, offer in offers:
+                yield offer
 
-            offers = root.xpath(
-                '*//guidle:offer',
-                namespaces={'guidle': 'http://www.guidle.com'}
-            )
-        except:
+                offer.clear()
+                while offer.getprevious() is not None:
+                    offer.getparent().remove(offer.getprevious())
+        except (etree.XMLSyntaxError, IOError):
             raise NoImportDataException()
+        finally:
+            xml.close()
+
+    def fetch(self, xml=None, parsed=None):
+        if parsed is None:
+            try:
+                # without a prefetched export the offers are parsed while
+                # the response is read
+                if xml is None:
+                    xml = urlopen(self.build_url(), timeout=300)
+                parsed = self.parse(xml)
+            except:
+                raise NoImportDataException()
+
+        offers = parsed
 
         classifier = queryAdapter(self, IGuidleClassifier)
         if not classifier:
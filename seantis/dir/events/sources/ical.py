@@ -39,14 +39,22 @@ class EventsSourceIcal(grok.Adapter):
     grok.context(IExternalEventSourceIcal)
     grok.provides(IExternalEventCollector)
 
-    def fetch(self, ical=None):
-        try:
-            if ical is None:
-                ical = urlopen(self.context.url).read()
-
-            calendar = icalendar.Calendar.from_ical(ical)
-        except:
-            raise NoImportDataException()
+    def build_url(self):
+        return self.context.url
+
+    def parse(self, ical):
+        return icalendar.Calendar.from_ical(ical)
+
+    def fetch(self, ical=None, parsed=None):
+        if parsed is None:
+            try:
+                if ical is None:
+                    ical = urlopen(self.build_url()).read()
+                parsed = self.parse(ical)
+            except:
+                raise NoImportDataException()
+
+        calendar = parsed
 
         for event in calendar.walk('vevent'):
 
@@ -45,16 +45,21 @@ class EventsSourceSeantisJson(grok.Adapter):
                 url += '&cat2=' + cat
         return url
 
-    def fetch(self, json_string=None):
+    def parse(self, json_string):
+        return json.loads(json_string)
 
-        try:
-            if json_string is None:
-                url = self.build_url()
-                json_string = urlopen(url, timeout=300).read()
+    def fetch(self, json_string=None, parsed=None):
 
-            events = json.loads(json_string)
-        except:
-            raise NoImportDataException()
+        if parsed is None:
+            try:
+                if json_string is None:
+                    url = self.build_url()
+                    json_string = urlopen(url, timeout=300).read()
+                parsed = self.parse(json_string)
+            except:
+                raise NoImportDataException()
+
+        events = parsed
 
         for event in events:
 
@@ -0,0 +1,284 @@
+import bisect
+
+from BTrees.IOBTree import IOBTree
+from BTrees.LLBTree import LLSet
+from BTrees.OIBTree import OIBTree
+from BTrees.OOBTree import OOSet
+from itertools import izip
+from persistent import Persistent
+from ZODB.POSException import ConflictError
+
+
+class PersistentSortedSet(Persistent):
+    """ A sorted set for the ZODB which stores its values in small BTree
+    buckets (each being a record of its own).
+
+    Adding or removing a value only writes the bucket containing the value
+    and this object, which merely holds the boundaries of the buckets. A
+    sorted set stored as a single record on the other hand is written as a
+    whole on every change.
+
+    Concurrent changes to the values are merged, as long as the buckets
+    themselves were neither split nor removed.
+
+    Mirrors the parts of blist.sortedset used by the event indices,
+    including the access by position.
+
+    """
+
+    bucket_type = OOSet
+    bucket_size = 256
+
+    def __init__(self, values=()):
+        self._buckets = []
+
+        # the lower bound of the values in each bucket - the bounds are
+        # only lowered by adding values, so that concurrent changes can
+        # be merged without knowing the values of the buckets
+        self._firsts = []
+        self._lengths = []
+
+        self.update(values)
+
+    def _locate(self, value):
+        """ Returns the position of the bucket the value belongs into. """
+        return max(bisect.bisect_right(self._firsts, value) - 1, 0)
+
+    def _offset(self, ix):
+        """ Returns the position of the first value in the given bucket. """
+        return sum(self._lengths[:ix])
+
+    def _split(self, ix):
+        bucket = self._buckets[ix]
+
+        values = list(bucket)
+        half = len(values) // 2
+
+        bucket.clear()
+        bucket.update(values[:half])
+
+        self._buckets.insert(ix + 1, self.bucket_type(values[half:]))
+        self._firsts.insert(ix + 1, values[half])
+        self._lengths[ix] = half
+        self._lengths.insert(ix + 1, len(values) - half)
+
+    def __len__(self):
+        return sum(self._lengths)
+
+    def __nonzero__(self):
+        return bool(self._buckets)
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            for value in bucket:
+                yield value
+
+    def __contains__(self, value):
+        if not self._buckets:
+            return False
+
+        return value in self._buckets[self._locate(value)]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+
+            if step != 1:
+                return list(self)[key]
+
+            return list(self.islice(start, stop))
+
+        length = len(self)
+
+        if key < 0:
+            key += length
+
+        if not 0 <= key < length:
+            raise IndexError(key)
+
+        for bucket, length in izip(self._buckets, self._lengths):
+            if key < length:
+                return bucket[key]
+
+            key -= length
+
+    def islice(self, start, stop):
+        """ Yields the values between the given positions. """
+        offset = 0
+
+        for bucket, length in izip(self._buckets, self._lengths):
+            if offset >= stop:
+                break
+
+            if offset + length > start:
+                first = max(start - offset, 0)
+                last = min(stop - offset, length)
+
+                for ix in xrange(first, last):
+                    yield bucket[ix]
+
+            offset += length
+
+    def bisect_left(self, value):
+        if not self._buckets:
+            return 0
+
+        ix = max(bisect.bisect_left(self._firsts, value) - 1, 0)
+        return self._offset(ix) + bisect.bisect_left(self._buckets[ix], value)
+
+    def bisect_right(self, value):
+        if not self._buckets:
+            return 0
+
+        ix = self._locate(value)
+        return self._offset(ix) + bisect.bisect_right(self._buckets[ix], value)
+
+    def add(self, value):
+        if not self._buckets:
+            self._buckets.append(self.bucket_type((value, )))
+            self._firsts.append(value)
+            self._lengths.append(1)
+            self._p_changed = True
+            return
+
+        ix = self._locate(value)
+
+        if not self._buckets[ix].insert(value):
+            return
+
+        self._lengths[ix] += 1
+
+        if value < self._firsts[ix]:
+            self._firsts[ix] = value
+
+        if self._lengths[ix] > self.bucket_size * 2:
+            self._split(ix)
+
+        self._p_changed = True
+
+    def discard(self, value):
+        if value not in self:
+            return
+
+        ix = self._locate(value)
+        bucket = self._buckets[ix]
+
+        bucket.remove(value)
+        self._lengths[ix] -= 1
+
+        if not self._lengths[ix]:
+            del self._buckets[ix]
+            del self._firsts[ix]
+            del self._lengths[ix]
+
+        self._p_changed = True
+
+    def remove(self, value):
+        if value not in self:
+            raise KeyError(value)
+
+        self.discard(value)
+
+    def update(self, values):
+        if self._buckets:
+            for value in values:
+                self.add(value)
+            return
+
+        # an empty set is filled with completely filled buckets
+        values = sorted(set(values))
+
+        for ix in xrange(0, len(values), self.bucket_size):
+            chunk = values[ix:ix + self.bucket_size]
+
+            self._buckets.append(self.bucket_type(chunk))
+            self._firsts.append(chunk[0])
+            self._lengths.append(len(chunk))
+
+        self._p_changed = True
+
+    def difference_update(self, values):
+        for value in values:
+            self.discard(value)
+
+    def clear(self):
+        self._buckets = []
+        self._firsts = []
+        self._lengths = []
+
+    def _p_resolveConflict(self, old, committed, new):
+        # the buckets merge the values themselves, which leaves the
+        # bookkeeping of their bounds and lengths to be merged here
+        if not old['_buckets'] == committed['_buckets'] == new['_buckets']:
+            raise ConflictError
+
+        merged = dict(new)
+        merged['_firsts'] = map(min, committed['_firsts'], new['_firsts'])
+        merged['_lengths'] = [
+            c + n - o for o, c, n in izip(
+                old['_lengths'], committed['_lengths'], new['_lengths']
+            )
+        ]
+
+        # emptied buckets have to be removed
+        if not all(merged['_lengths']):
+            raise ConflictError
+
+        return merged
+
+
+class PersistentSortedIntegerSet(PersistentSortedSet):
+    """ A PersistentSortedSet for 64 bit integers, which are stored as
+    plain arrays instead of pickled objects. """
+
+    bucket_type = LLSet
+
+
+class IntegerIds(Persistent):
+    """ Maps string ids to small integers and back. The integers are
+    assigned in ascending order and never reused, not even once released.
+
+    """
+
+    # the last integer assigned
+    last = 0
+
+    def __init__(self):
+        self.ids = OIBTree()
+        self.names = IOBTree()
+
+    def register(self, name):
+        """ Returns the integer of the given name, assigning a new one if
+        the name is not known yet.
+
+        """
+        intid = self.ids.get(name)
+
+        if intid is None:
+            try:
+                intid = max(self.last, self.names.maxKey()) + 1
+            except ValueError:
+                intid = self.last + 1
+
+            self.last = intid
+            self.ids[name] = intid
+            self.names[intid] = name
+
+        return intid
+
+    def release(self, name):
+        """ Forgets the integer of the given name, which must no longer be
+        used by any index.
+
+        """
+        intid = self.ids.get(name)
+
+        if intid is not None:
+            del self.ids[name]
+            del self.names[intid]
+
+    def get(self, name, default=None):
+        return self.ids.get(name, default)
+
+    def name(self, intid):
+        return self.names[intid]
@@ -0,0 +1,270 @@
+# Synthetic events and timings for the benchmarks in test_benchmark.py,
+# which are only run if the seantis_events_benchmark variable is set.
+import json
+import platform
+import pkg_resources
+import sys
+
+from datetime import datetime, timedelta
+from random import Random
+from timeit import default_timer
+from xml.sax.saxutils import escape, quoteattr
+
+
+# the options of the benchmark, which may be overridden through the
+# seantis_events_benchmark_options variable ('events=10000,recurring=0.6')
+defaults = dict(
+    events=1000,        # the number of events in the directory
+    scale=4,            # the factor of the events in the larger directory
+    recurring=0.6,      # the share of recurring events
+    multiday=0.1,       # the share of events lasting more than one day
+    submitted=0.05,     # the share of events which are not published
+    categories=20,      # the number of values of each category
+    offers=100,         # the number of offers in the guidle export
+    repeat=5,           # the number of times each operation is timed
+    seed=42             # the seed of the random events
+)
+
+
+def options(text=''):
+    """ Returns the options of the benchmark, with the defaults overridden
+    by the given text.
+
+    """
+    result = dict(defaults)
+
+    for option in (o.strip() for o in text.split(',')):
+        if not option:
+            continue
+
+        key, value = map(str.strip, option.split('=', 1))
+        assert key in defaults, "unknown option %s" % key
+
+        result[key] = type(defaults[key])(value)
+
+    return result
+
+
+WORDS = (
+    u'concert', u'market', u'reading', u'exhibition', u'theatre',
+    u'tour', u'workshop', u'festival', u'lecture', u'dance'
+)
+
+WEEKDAYS = (u'Mo', u'Tu', u'We', u'Th', u'Fr', u'Sa', u'Su')
+
+RECURRENCES = (
+    'RRULE:FREQ=DAILY;COUNT=%i',
+    'RRULE:FREQ=WEEKLY;COUNT=%i',
+    'RRULE:FREQ=WEEKLY;BYDAY=MO,WE,FR;COUNT=%i'
+)
+
+GUIDLE_EXPORT = u"""<?xml version="1.0" encoding="UTF-8"?>
+<guidle:exportData xmlns:guidle="http://www.guidle.com">
+<guidle:groupSet>
+<guidle:group>
+%s
+</guidle:group>
+</guidle:groupSet>
+</guidle:exportData>
+"""
+
+GUIDLE_OFFER = u"""<guidle:offer id="%(id)s">
+<guidle:lastUpdateDate>%(updated)s</guidle:lastUpdateDate>
+<guidle:offerDetail>
+  <guidle:title>%(title)s</guidle:title>
+  <guidle:shortDescription>%(description)s</guidle:shortDescription>
+</guidle:offerDetail>
+<guidle:address>
+  <guidle:company>%(company)s</guidle:company>
+  <guidle:city>%(town)s</guidle:city>
+</guidle:address>
+<guidle:contact>
+  <guidle:email>info@example.org</guidle:email>
+</guidle:contact>
+<guidle:schedules>
+  <guidle:date>
+%(schedule)s
+  </guidle:date>
+</guidle:schedules>
+<guidle:classifications>
+  <guidle:classification name="benchmark" type="PRIMARY">
+    <guidle:tag subcategoryName=%(category)s/>
+  </guidle:classification>
+</guidle:classifications>
+</guidle:offer>"""
+
+
+class EventGenerator(object):
+    """ Generates random events, which are the same for the same options
+    (relative to today).
+
+    """
+
+    def __init__(self, options, today=None):
+        self.options = options
+        self.random = Random(options['seed'])
+        self.today = today or datetime.today().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+
+        count = options['categories']
+        self.categories = [u'Category %i' % i for i in range(1, count + 1)]
+        self.towns = [u'Town %i' % i for i in range(1, count + 1)]
+
+    def chance(self, option):
+        return self.random.random() < self.options[option]
+
+    def title(self, ix):
+        return u'%s %s %i' % (
+            self.random.choice(WORDS).title(), self.random.choice(WORDS), ix
+        )
+
+    def event(self, ix):
+        """ Returns the attributes of a new event and its review state. """
+        random = self.random
+
+        start = self.today + timedelta(
+            days=random.randint(0, 364),
+            hours=random.randint(8, 21),
+            minutes=random.choice((0, 15, 30, 45))
+        )
+
+        if self.chance('multiday'):
+            end = start + timedelta(days=random.randint(1, 4))
+        else:
+            end = start + timedelta(hours=random.randint(1, 3))
+
+        if self.chance('recurring'):
+            recurrence = random.choice(RECURRENCES) % random.randint(2, 20)
+        else:
+            recurrence = ''
+
+        attributes = dict(
+            title=self.title(ix),
+            short_description=u' '.join(random.sample(WORDS, 5)),
+            start=start,
+            end=end,
+            timezone='Europe/Zurich',
+            recurrence=recurrence,
+            cat1=random.sample(self.categories, random.randint(1, 2)),
+            cat2=[random.choice(self.towns)]
+        )
+
+        state = 'submitted' if self.chance('submitted') else 'published'
+
+        return attributes, state
+
+    def schedule(self):
+        """ Returns the children of a date in a guidle export. """
+        random = self.random
+
+        start = self.today + timedelta(days=random.randint(0, 364))
+        lines = [u'<guidle:startDate>%s</guidle:startDate>' % start.date()]
+
+        if self.chance('recurring'):
+            end = start + timedelta(weeks=random.randint(1, 10))
+            days = sorted(random.sample(range(7), random.randint(1, 3)))
+            days = [WEEKDAYS[day] for day in days]
+
+            lines.append(u'<guidle:endDate>%s</guidle:endDate>' % end.date())
+            lines.append(u'<guidle:weekdays>%s</guidle:weekdays>' % u''.join(
+                u'<guidle:day>%s</guidle:day>' % day for day in days
+            ))
+        elif self.chance('multiday'):
+            end = start + timedelta(days=random.randint(1, 4))
+            lines.append(u'<guidle:endDate>%s</guidle:endDate>' % end.date())
+        else:
+            hour = random.randint(8, 21)
+            lines.append(u'<guidle:endDate>%s</guidle:endDate>' % start.date())
+            lines.append(u'<guidle:startTime>%02i:00:00</guidle:startTime>' % (
+                hour
+            ))
+            lines.append(u'<guidle:endTime>%02i:30:00</guidle:endTime>' % (
+                hour + 1
+            ))
+
+        return u'\n'.join(u'    ' + line for line in lines)
+
+    def guidle_export(self, count):
+        """ Returns a guidle export with the given number of offers. """
+        offers = []
+
+        for ix in xrange(count):
+            offers.append(GUIDLE_OFFER % dict(
+                id='benchmark-%i' % ix,
+                updated='%sT00:00:00+01:00' % self.today.date(),
+                title=escape(self.title(ix)),
+                description=escape(u' '.join(self.random.sample(WORDS, 5))),
+                company=u'Company %i' % ix,
+                town=escape(self.random.choice(self.towns)),
+                schedule=self.schedule(),
+                category=quoteattr(self.random.choice(self.categories))
+            ))
+
+        return (GUIDLE_EXPORT % u'\n'.join(offers)).encode('utf-8')
+
+
+class Benchmark(object):
+    """ Times operations and reports the results as json. """
+
+    def __init__(self, options):
+        self.options = options
+        self.results = []
+
+    def measure(self, name, function, setup=None, repeat=None, **info):
+        """ Calls the given function repeatedly and records the time the
+        calls took, under the given name and with the given information.
+        The setup function is called before each call, untimed.
+
+        Returns the result of the last call.
+
+        """
+        times = []
+
+        for i in xrange(repeat or self.options['repeat']):
+            if setup is not None:
+                setup()
+
+            begin = default_timer()
+            result = function()
+            times.append(default_timer() - begin)
+
+        times.sort()
+
+        measurement = dict(
+            name=name,
+            repeat=len(times),
+            min=times[0],
+            median=times[len(times) // 2],
+            max=times[-1]
+        )
+        measurement.update(info)
+
+        self.results.append(measurement)
+
+        return result
+
+    def report(self):
+        return dict(
+            package='seantis.dir.events',
+            version=pkg_resources.get_distribution(
+                'seantis.dir.events'
+            ).version,
+            python=platform.python_version(),
+            date=datetime.utcnow().isoformat(),
+            options=self.options,
+            results=self.results
+        )
+
+    def write(self, path):
+        """ Writes the report to the given path, or to stdout if the path
+        is '-'.
+
+        """
+        report = json.dumps(self.report(), indent=2, sort_keys=True)
+
+        if path == '-':
+            sys.stdout.write(report + '\n')
+        else:
+            with open(path, 'w') as f:
+                f.write(report)
@@ -0,0 +1,218 @@
+import mock
+import os
+import transaction
+
+from datetime import timedelta
+from pytz import utc
+from seantis.dir.base.const import ITEMSPERPAGE
+from seantis.dir.base.interfaces import IDirectoryCatalog
+from seantis.dir.events import calendars
+from seantis.dir.events import recurrence
+from seantis.dir.events import utils
+from seantis.dir.events.catalog import submitted_counts
+from seantis.dir.events.cleanup import cleanup_scheduler
+from seantis.dir.events.sources import ExternalEventImporter
+from seantis.dir.events.sources.guidle import EventsSourceGuidle
+from seantis.dir.events.tests import IntegrationTestCase
+from seantis.dir.events.tests.benchmark import (
+    Benchmark,
+    EventGenerator,
+    options
+)
+from StringIO import StringIO
+from unittest2 import skipUnless
+from zope.component import getAdapter
+
+
+@skipUnless(
+    os.getenv('seantis_events_benchmark'),
+    'set seantis_events_benchmark to the path of the results to run'
+)
+class TestBenchmark(IntegrationTestCase):
+
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+
+        self.options = options(
+            os.getenv('seantis_events_benchmark_options', '')
+        )
+        self.generator = EventGenerator(self.options)
+        self.benchmark = Benchmark(self.options)
+
+    def fresh_catalog(self):
+        """ Returns a new catalog, like the one of each request. """
+        catalog = getAdapter(self.directory, IDirectoryCatalog)
+        catalog.daterange = 'this_and_next_year'
+
+        return catalog
+
+    def create_events(self, start, count):
+        # the indices are built once all events exist, by the benchmark
+        self.directory._v_fetching = True
+
+        try:
+            for ix in xrange(start, start + count):
+                attributes, state = self.generator.event(ix)
+
+                event = self.create_event(**attributes)
+                event.submit()
+
+                if state == 'published':
+                    event.publish()
+
+            transaction.commit()
+        finally:
+            self.directory._v_fetching = False
+
+    def page(self, number, occurrences=lambda catalog: catalog.lazy_list):
+        """ Resolves the given page of the occurrences, as the directory
+        view does.
+
+        """
+        occurrences = occurrences(self.fresh_catalog())
+        occurrences.window = ITEMSPERPAGE
+
+        start = number * ITEMSPERPAGE
+        return occurrences[start:start + ITEMSPERPAGE]
+
+    def measure_queries(self, term):
+        """ Measures the listing and the filter, which are measured with
+        a small and a large directory to compare how they scale.
+
+        """
+        catalog = self.fresh_catalog()
+        info = dict(
+            events=len(catalog.query()), occurrences=len(catalog.lazy_list)
+        )
+
+        self.benchmark.measure(
+            'listing.first_page', lambda: self.page(0), **info
+        )
+        self.benchmark.measure(
+            'filter', lambda: self.page(0, lambda c: c.filter(term)), **info
+        )
+
+    def filter_values(self):
+        return self.fresh_catalog().grouped_possible_values(
+            categories=('cat1', 'cat2')
+        )
+
+    def export_json(self, compact):
+        output = StringIO()
+        utils.write_json(output.write, self.fresh_catalog().export(), compact)
+
+        return output.tell()
+
+    def test_benchmark(self):
+        self.login_testuser()
+
+        measure = self.benchmark.measure
+
+        try:
+            self.create_events(0, self.options['events'])
+
+            measure('reindex', self.catalog.reindex)
+            transaction.commit()
+
+            term = {'cat1': self.generator.categories[0]}
+            self.measure_queries(term)
+
+            occurrences = len(self.fresh_catalog().lazy_list)
+            last_page = max(occurrences - 1, 0) // ITEMSPERPAGE
+
+            measure(
+                'listing.last_page', lambda: self.page(last_page),
+                occurrences=occurrences
+            )
+            measure(
+                'listing.submitted_count',
+                lambda: self.fresh_catalog().submitted_count,
+                setup=submitted_counts.clear
+            )
+
+            measure('filter.values', self.filter_values)
+
+            # removing an event depends on its occurrences only, it is
+            # added again before each removal and once measured
+            ix = self.fresh_catalog().indices['published']
+            id = ix.identities.minKey()
+            identities = ix.identities[id]
+
+            measure(
+                'index.remove', lambda: ix.remove([id]),
+                setup=lambda: ix.replace(id, identities),
+                occurrences=len(ix.index)
+            )
+            ix.replace(id, identities)
+
+            text = self.generator.title(0).split()[0]
+            measure(
+                'search', lambda: self.page(0, lambda c: c.search(text))
+            )
+
+            measure('export.json', lambda: self.export_json(False))
+            measure('export.json.compact', lambda: self.export_json(True))
+            measure(
+                'export.ical', lambda: self.fresh_catalog().ical(),
+                setup=calendars.fragments.clear
+            )
+            measure('export.ical.cached', lambda: self.fresh_catalog().ical())
+
+            # the occurrences of a rule over several years, through the
+            # arithmetic for simple rules and through the generic iterator
+            start = self.generator.today.replace(tzinfo=utc)
+            rule = 'RRULE:FREQ=WEEKLY;BYDAY=MO,WE,FR'
+            until = start + timedelta(days=366 * 6)
+
+            measure('recurrence.simple', lambda: recurrence.simple_sequence(
+                rule, start, start, until
+            ))
+            measure('recurrence.generic', lambda: list(
+                recurrence.recurrence_sequence_ical(
+                    start, recrule=rule, from_=start, until=until
+                )
+            ))
+
+            measure('cleanup', lambda: cleanup_scheduler.cleanup_directory(
+                self.directory, dryrun=True
+            ))
+
+            context = mock.Mock()
+            context.url = 'benchmark'
+
+            source = EventsSourceGuidle(context)
+            export = self.generator.guidle_export(self.options['offers'])
+            fetch = lambda: source.fetch(export)
+
+            importer = ExternalEventImporter(self.directory)
+
+            imported, deleted = measure(
+                'import.guidle', lambda: importer.fetch_one(
+                    'benchmark', fetch, reimport=True
+                ), offers=self.options['offers']
+            )
+            self.assertTrue(imported > 0)
+
+            imported, deleted = measure(
+                'import.guidle.unchanged', lambda: importer.fetch_one(
+                    'benchmark', fetch
+                ), offers=self.options['offers']
+            )
+            self.assertEqual(imported, 0)
+
+            # the same queries with a larger directory
+            self.create_events(
+                self.options['events'],
+                self.options['events'] * (self.options['scale'] - 1)
+            )
+            self.catalog.reindex()
+            transaction.commit()
+
+            self.measure_queries(term)
+
+            self.benchmark.write(os.getenv('seantis_events_benchmark'))
+
+        finally:
+            self.directory.manage_delObjects(self.directory.keys())
+            self.portal.manage_delObjects([self.directory.id])
+            transaction.commit()
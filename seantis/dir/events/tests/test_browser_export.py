@@ -1,3 +1,4 @@
+import json
 import pytz
 
 from datetime import datetime, timedelta
@@ -34,6 +35,7 @@ class CommonBrowserTests(BrowserTestCase):
         self.assertTrue('Category2_2' in browser.contents)
         self.assertTrue(first_date.isoformat() in browser.contents)
         self.assertTrue(second_date.isoformat() in browser.contents)
+        self.assertEqual(len(json.loads(browser.contents)), 3)
 
         # Export compact
         browser.open('/veranstaltungen?type=json&compact=1')
@@ -94,6 +96,30 @@ class CommonBrowserTests(BrowserTestCase):
         self.assertTrue('test1' in browser.contents)
         self.assertTrue('test2' not in browser.contents)
 
+    def test_json_export_snapshots(self):
+        self.addEvent(title='test1')
+
+        browser = self.new_browser()
+        browser.open('/veranstaltungen?type=json')
+        etag = browser.headers['ETag']
+        self.assertTrue(browser.headers['Last-Modified'])
+        self.assertTrue('test1' in browser.contents)
+
+        browser.open('/veranstaltungen?type=json')
+        self.assertEqual(browser.headers['ETag'], etag)
+        self.assertEqual(len(json.loads(browser.contents)), 1)
+
+        browser.open('/veranstaltungen?type=json&compact=1')
+        self.assertNotEqual(browser.headers['ETag'], etag)
+
+        # changes to the events lead to a new export
+        self.addEvent(title='test2')
+
+        browser.open('/veranstaltungen?type=json')
+        self.assertNotEqual(browser.headers['ETag'], etag)
+        self.assertTrue('test1' in browser.contents)
+        self.assertTrue('test2' in browser.contents)
+
     def test_issue_17(self):
         self.addEvent(title='test1')
         self.addEvent(title='test2', date=datetime.today() - timedelta(days=2),
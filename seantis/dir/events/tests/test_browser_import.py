@@ -84,8 +84,10 @@ class CommonBrowserTests(BrowserTestCase):
         browser.open('/veranstaltungen/')
         self.assertTrue(title in browser.contents)
 
+    @mock.patch('seantis.dir.events.sources.prefetch')
     @mock.patch('seantis.dir.events.sources.guidle.EventsSourceGuidle.fetch')
-    def test_browser_import_guidle(self, fetch):
+    def test_browser_import_guidle(self, fetch, prefetch):
+        prefetch.return_value = ([], 0.0, None, True)
         anom = self.new_browser()
         admin = self.admin_browser
 
@@ -193,8 +195,10 @@ class CommonBrowserTests(BrowserTestCase):
         browser.open('/@@rules-controlpanel')
         self.assertTrue(title in browser.contents)
 
+    @mock.patch('seantis.dir.events.sources.prefetch')
     @mock.patch('seantis.dir.events.sources.guidle.EventsSourceGuidle.fetch')
-    def test_browser_import_content_rule(self, fetch):
+    def test_browser_import_content_rule(self, fetch, prefetch):
+        prefetch.return_value = ([], 0.0, None, True)
         browser = self.admin_browser
 
         # Add first guidle source
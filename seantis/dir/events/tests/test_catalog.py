@@ -1,17 +1,25 @@
+import icalendar
+import pytz
 import transaction
 
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from seantis.dir.base.interfaces import IDirectoryCatalog
+from seantis.dir.events import calendars
 from seantis.dir.events import dates
+from seantis.dir.events import utils
 from seantis.dir.events.tests import IntegrationTestCase
 
 from seantis.dir.events.catalog import (
     LazyList,
+    EventCategoryIndex,
     EventOrderIndex,
     attach_reindex_to_transaction,
     ReindexDataManager,
 )
 
-from mock import Mock
+from mock import Mock, patch
+from zope.component import getAdapter
+from zope.publisher.browser import TestRequest
 
 
 class TestCatalog(IntegrationTestCase):
@@ -78,3 +86,293 @@ class TestCatalog(IntegrationTestCase):
         self.directory.manage_delObjects(['1', '2', '3', '4'])
         self.portal.manage_delObjects([self.directory.id])
         transaction.commit()
+
+    def test_category_index(self):
+
+        self.login_testuser()
+
+        events = [
+            self.create_event(title='1', cat1=['a'], cat2=['1']),
+            self.create_event(title='2', cat1=['a', 'b'], cat2=['2']),
+            self.create_event(title='3', cat1=['b', 'c'], cat2=['2', '3']),
+            self.create_event(title='4', cat1=['c'], cat2=['1', '3'])
+        ]
+        for event in events:
+            event.submit()
+            event.publish()
+        transaction.commit()
+
+        ix = self.catalog.category_indices['published']
+        titles = dict((event.id, event.title) for event in events)
+
+        def _match(term, operator='or'):
+            return sorted(
+                titles[ix.ids.name(intid)]
+                for intid in ix.match(term, operator)
+            )
+
+        self.assertEqual(ix.match({}), None)
+        self.assertEqual(ix.match({'cat1': '!empty', 'cat2': ''}), None)
+        self.assertEqual(_match({'cat1': 'a'}), ['1', '2'])
+        self.assertEqual(_match({'cat1': ['a', 'c']}), ['1', '2', '3', '4'])
+        self.assertEqual(_match({'cat1': ['b', 'c']}, 'and'), ['3'])
+        self.assertEqual(_match({'cat1': 'b', 'cat2': '3'}), ['3'])
+        self.assertEqual(_match({'cat1': 'x'}), [])
+
+        self.assertEqual(ix.counts(['cat1', 'cat2']), {
+            'cat1': {u'a': 2, u'b': 2, u'c': 2},
+            'cat2': {u'1': 2, u'2': 2, u'3': 2}
+        })
+        self.assertEqual(
+            ix.counts(['cat1'], subset=ix.match({'cat2': '1'})),
+            {'cat1': {u'a': 1, u'c': 1}}
+        )
+        self.assertEqual(
+            self.catalog.grouped_possible_values(categories=['cat2']),
+            {'cat2': {u'1': 2, u'2': 2, u'3': 2}}
+        )
+
+        filtered = self.catalog.filter({'cat1': 'b', 'cat2': '!empty'})
+        self.assertEqual(sorted(o.title for o in filtered), ['2', '3'])
+
+        # events leaving the state are removed from the index
+        events[0].archive()
+        transaction.commit()
+
+        self.assertEqual(_match({'cat1': 'a'}), ['2'])
+        self.assertEqual(ix.counts(['cat1'])['cat1'][u'a'], 1)
+
+        ix.reindex()
+        self.assertEqual(_match({'cat1': 'a'}), ['2'])
+
+    def test_empty_indices(self):
+
+        # the indices of a directory without events or categories are built
+        # once, not by each catalog
+        for ix in self.catalog.category_indices.values():
+            self.assertEqual(len(ix.index), 0)
+
+        with patch.object(EventOrderIndex, 'reindex') as order:
+            with patch.object(EventCategoryIndex, 'reindex') as categories:
+                getAdapter(self.directory, IDirectoryCatalog)
+
+        self.assertFalse(order.called)
+        self.assertFalse(categories.called)
+
+    def test_release_ids(self):
+
+        self.login_testuser()
+
+        events = [self.create_event(title=str(i)) for i in range(3)]
+        for event in events:
+            event.submit()
+            event.publish()
+        transaction.commit()
+
+        ids = self.catalog.indices['published'].ids
+        names = [event.id for event in events]
+        intids = [ids.get(name) for name in names]
+        self.assertTrue(None not in intids)
+
+        # events leaving a state keep their integer id
+        events[0].archive()
+        transaction.commit()
+        self.assertEqual(ids.get(names[0]), intids[0])
+
+        # removed events release it, the integer ids are never reused
+        self.directory.manage_delObjects(names[1:])
+        transaction.commit()
+        self.assertEqual([ids.get(name) for name in names[1:]], [None, None])
+
+        event = self.create_event(title='new')
+        event.submit()
+        transaction.commit()
+        self.assertTrue(ids.get(event.id) > max(intids))
+
+        self.catalog.reindex()
+        self.assertEqual(
+            sorted(ids.ids.keys()), sorted((names[0], event.id))
+        )
+
+        self.directory.manage_delObjects(self.directory.keys())
+        self.portal.manage_delObjects([self.directory.id])
+        transaction.commit()
+
+    def test_search(self):
+
+        self.login_testuser()
+
+        events = [
+            self.create_event(
+                title='Concert', cat1=['music'],
+                recurrence='RRULE:FREQ=DAILY;COUNT=10'
+            ),
+            self.create_event(title='Concert Rehearsal', cat1=['music']),
+            self.create_event(title='Reading', cat1=['books']),
+            self.create_event(
+                title='Concert Tour', cat1=['tour'],
+                start=datetime.today() + timedelta(days=366 * 3),
+                end=datetime.today() + timedelta(days=366 * 3, hours=1)
+            )
+        ]
+        for event in events:
+            event.submit()
+            event.publish()
+        transaction.commit()
+
+        self.catalog.daterange = 'this_and_next_year'
+        results = self.catalog.search('Concert')
+
+        # the occurrences are resolved on access, from the order index
+        self.assertTrue(isinstance(results, LazyList))
+        self.assertEqual(len(results), 11)
+
+        ix = self.catalog.indices['published']
+        ix.resolved.clear()
+
+        self.assertEqual(set(o.title for o in results[:5]), set(['Concert']))
+        self.assertEqual(len(ix.resolved), 5)
+
+        starts = [o.start for o in results]
+        self.assertEqual(starts, sorted(starts))
+
+        # the occurrences in the date range are counted
+        self.assertEqual(
+            self.catalog.grouped_possible_values(results, ['cat1']),
+            {'cat1': {u'music': 11}}
+        )
+        self.assertEqual(
+            self.catalog.grouped_possible_values(categories=['cat1']),
+            {'cat1': {u'music': 11, u'books': 1}}
+        )
+
+        self.assertEqual(len(self.catalog.search('Nothing')), 0)
+
+    def test_modified(self):
+        self.login_testuser()
+
+        before = self.catalog.modified
+
+        event = self.create_event()
+        event.submit()
+        transaction.commit()
+
+        modified = self.catalog.modified
+        self.assertTrue(modified is not None)
+        self.assertNotEqual(modified, before)
+
+        event.publish()
+        transaction.commit()
+
+        self.assertTrue(self.catalog.modified > modified)
+
+    def test_submitted_count(self):
+        self.login_testuser()
+
+        self.assertEqual(self.catalog.submitted_count, 0)
+
+        event = self.create_event(recurrence='RRULE:FREQ=DAILY;COUNT=3')
+        event.submit()
+        self.create_event().submit()
+        self.create_event().submit()
+        transaction.commit()
+
+        submitted = self.catalog.query(review_state='submitted')
+        expected = len(list(self.catalog.spawn(submitted)))
+
+        self.assertTrue(expected >= 2)
+        self.assertEqual(self.catalog.submitted_count, expected)
+
+        # the count is cached until the events change
+        self.assertEqual(self.catalog.submitted_count, expected)
+
+        event.publish()
+        transaction.commit()
+
+        self.assertEqual(self.catalog.submitted_count, 2)
+
+        # the count is cached by the roles of the user on the directory
+        with patch.object(
+            type(self.directory), 'allow_action', return_value=False
+        ):
+            self.assertEqual(self.catalog.submitted_count, 2)
+
+            self.directory.manage_addLocalRoles('test-user', ['Reviewer'])
+            self.assertEqual(self.catalog.submitted_count, 0)
+
+    def test_is_not_modified(self):
+        modified = datetime(2014, 1, 1, 12, tzinfo=pytz.utc)
+
+        def request(**headers):
+            return TestRequest(environ=dict(
+                ('HTTP_' + key.upper(), value)
+                for key, value in headers.items()
+            ))
+
+        self.assertFalse(utils.is_not_modified(request(), '"a"', modified))
+
+        self.assertTrue(utils.is_not_modified(
+            request(if_none_match='"a"'), '"a"', modified
+        ))
+        self.assertTrue(utils.is_not_modified(
+            request(if_none_match='"b", "a"'), '"a"', modified
+        ))
+        self.assertFalse(utils.is_not_modified(
+            request(if_none_match='"b"'), '"a"', modified
+        ))
+
+        self.assertTrue(utils.is_not_modified(
+            request(if_modified_since='Wed, 01 Jan 2014 12:00:00 GMT'),
+            '"a"', modified
+        ))
+        self.assertFalse(utils.is_not_modified(
+            request(if_modified_since='Wed, 01 Jan 2014 11:59:59 GMT'),
+            '"a"', modified
+        ))
+        self.assertFalse(utils.is_not_modified(
+            request(if_modified_since='Wed, 01 Jan 2014 12:00:00 GMT'),
+            '"a"', None
+        ))
+
+    def test_ical(self):
+        self.login_testuser()
+
+        events = [
+            self.create_event(title='1'),
+            self.create_event(
+                title='2', recurrence='RRULE:FREQ=DAILY;COUNT=2',
+                timezone='Europe/Vienna'
+            ),
+            self.create_event(title='3', whole_day=True)
+        ]
+        for event in events:
+            event.submit()
+            event.publish()
+
+        transaction.commit()
+
+        def components(ical):
+            return sorted(
+                (
+                    c.name, c.get('summary'), c.get('uid'), c.get('rrule'),
+                    'dtstart' in c and c.decoded('dtstart') or None,
+                    'dtend' in c and c.decoded('dtend') or None,
+                ) for c in icalendar.Calendar.from_ical(ical).walk()
+            )
+
+        calendars.fragments.clear()
+        hits = calendars.fragments.hits
+
+        expected = components(self.catalog.calendar().to_ical())
+        self.assertEqual(components(self.catalog.ical()), expected)
+        self.assertEqual(calendars.fragments.hits, hits)
+
+        self.assertEqual(components(self.catalog.ical()), expected)
+        self.assertEqual(calendars.fragments.hits, hits + 3)
+
+        # changed events are serialized again
+        events[0].title = u'changed'
+        events[0].reindexObject()
+
+        self.assertTrue('changed' in self.catalog.ical())
+        self.assertEqual(calendars.fragments.hits, hits + 5)
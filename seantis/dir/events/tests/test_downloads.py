@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from seantis.dir.events.downloads import DownloadCache
+from seantis.dir.events.tests import IntegrationTestCase
+from threading import Thread
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    requests = []
+    files = {}
+
+    def do_GET(self):
+        self.requests.append(self.path)
+
+        data = self.files[self.path]
+        etag = '"%i"' % hash(data)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestDownloads(IntegrationTestCase):
+
+    def setUp(self):
+        super(TestDownloads, self).setUp()
+
+        Handler.requests = []
+        Handler.files = {}
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+        shutil.rmtree(self.path)
+
+        super(TestDownloads, self).tearDown()
+
+    def url(self, path):
+        return 'http://127.0.0.1:%i%s' % (self.server.server_port, path)
+
+    def test_download_cache(self):
+        Handler.files['/a'] = 'a' * 100
+        Handler.files['/b'] = 'b' * 100
+
+        cache = DownloadCache(self.path, size=150)
+
+        self.assertEqual(cache.get(self.url('/a')), 'a' * 100)
+        self.assertEqual(cache.read(self.url('/a'))[0], 'a' * 100)
+        self.assertEqual(cache.total, 100)
+
+        # unchanged files are not transferred again
+        self.assertEqual(cache.get(self.url('/a')), 'a' * 100)
+        self.assertEqual(Handler.requests, ['/a', '/a'])
+
+        # which is true for other instances using the same directory
+        self.assertEqual(
+            DownloadCache(self.path).read(self.url('/a'))[0], 'a' * 100
+        )
+
+        # changed files are
+        Handler.files['/a'] = 'c' * 100
+        self.assertEqual(cache.get(self.url('/a')), 'c' * 100)
+        self.assertEqual(cache.read(self.url('/a'))[0], 'c' * 100)
+
+        # without listing the files again while the cache fits
+        self.assertEqual(cache.total, 100)
+
+        # the least recently used files are removed if the cache is full
+        self.assertEqual(cache.get(self.url('/b')), 'b' * 100)
+        self.assertEqual(cache.read(self.url('/a')), None)
+        self.assertEqual(cache.read(self.url('/b'))[0], 'b' * 100)
+        self.assertEqual(cache.total, 100)
+
+        self.assertEqual(len(os.listdir(self.path)), 2)
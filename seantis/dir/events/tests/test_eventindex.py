@@ -1,7 +1,15 @@
 import transaction
 
-from datetime import date, datetime
+from BTrees.IIBTree import IITreeSet
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta
+from random import Random
 from seantis.dir.events import dates
+from seantis.dir.events import utils
+from seantis.dir.events.storage import (
+    PersistentSortedSet,
+    PersistentSortedIntegerSet
+)
 from seantis.dir.events.tests import IntegrationTestCase
 
 from seantis.dir.events.catalog import (
@@ -11,7 +19,22 @@ from seantis.dir.events.catalog import (
     ReindexDataManager,
 )
 
-from mock import Mock
+from mock import Mock, patch
+from ZODB import DB
+from ZODB.DemoStorage import DemoStorage
+from ZODB.POSException import ConflictError
+
+
+class MockCatalog(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def query(self, **kwargs):
+        return []
+
+    def spawn(self, realitems, start, end):
+        return []
 
 
 class TestEventIndex(IntegrationTestCase):
@@ -45,6 +68,167 @@ class TestEventIndex(IntegrationTestCase):
         lazy[5:100]
         self.assertEqual(lazy._get_item.call_count, 5)
 
+        # test batched slicing
+        get_items = Mock(side_effect=lambda indices: list(indices))
+        lazy = LazyList(Mock(), 10, get_items)
+        self.assertEqual(lazy[2:5], [2, 3, 4])
+        self.assertEqual(lazy[0:4], [0, 1, 2, 3])
+        self.assertEqual(lazy._get_item.call_count, 0)
+        self.assertEqual(get_items.call_count, 2)
+        self.assertEqual(get_items.call_args[0][0], [0, 1])
+
+        lazy[1:3]
+        self.assertEqual(get_items.call_count, 2)
+
+        # test resolving windows
+        get_items = Mock(side_effect=lambda indices: list(indices))
+        lazy = LazyList(Mock(), 10, get_items, window=4)
+        self.assertEqual(lazy[3], 3)
+        self.assertEqual(get_items.call_args[0][0], [3, 4, 5, 6])
+        self.assertEqual([lazy[i] for i in range(3, 7)], [3, 4, 5, 6])
+        self.assertEqual(get_items.call_count, 1)
+
+        self.assertEqual(lazy[8], 8)
+        self.assertEqual(get_items.call_args[0][0], [8, 9])
+        self.assertEqual(lazy._get_item.call_count, 0)
+
+    def test_lazy_list_iteration(self):
+        get_items = Mock(side_effect=lambda indices: list(indices))
+        lazy = LazyList(Mock(), 10, get_items, window=4)
+
+        lazy[1]
+        self.assertEqual(list(lazy), range(10))
+        self.assertEqual(
+            [c[0][0] for c in get_items.call_args_list],
+            [[1, 2, 3, 4], [0], [5, 6, 7], [8, 9]]
+        )
+
+        # items resolved through iteration are not kept
+        self.assertEqual(lazy.cache[8], lazy._get_item)
+        self.assertEqual(lazy._get_item.call_count, 0)
+
+    def test_lru_cache(self):
+        cache = utils.LRUCache(2)
+
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+
+        cache.clear()
+        self.assertFalse('a' in cache)
+
+        # the size may limit the total weight of the values instead
+        cache = utils.LRUCache(5, weight=len)
+
+        cache['a'] = 'aa'
+        cache['b'] = 'bbb'
+        self.assertEqual(cache.total, 5)
+
+        cache['a'] = 'a'
+        self.assertEqual(cache.total, 4)
+
+        cache['c'] = 'cc'
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.total, 3)
+        self.assertEqual(len(cache), 2)
+
+        # values heavier than the cache are not kept
+        cache['d'] = 'dddddd'
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.total, 0)
+
+    def test_persistent_sorted_set(self):
+
+        random = Random(42)
+
+        class SmallBucketsSet(PersistentSortedSet):
+            bucket_size = 4
+
+        values = SmallBucketsSet(random.randint(0, 50) for i in range(20))
+        expected = sorted(set(values))
+
+        for i in range(500):
+            value = random.randint(0, 60)
+
+            if random.random() < 0.5:
+                values.add(value)
+                expected = sorted(set(expected + [value]))
+            else:
+                values.discard(value)
+                expected = [v for v in expected if v != value]
+
+            self.assertEqual(list(values), expected)
+            self.assertEqual(len(values), len(expected))
+            self.assertEqual(value in values, value in expected)
+            self.assertEqual(
+                values.bisect_left(value), bisect_left(expected, value)
+            )
+            self.assertEqual(
+                values.bisect_right(value), bisect_right(expected, value)
+            )
+
+            start, end = random.randint(-5, 40), random.randint(-5, 40)
+            self.assertEqual(values[start:end], expected[start:end])
+
+            if expected:
+                self.assertEqual(values[0], expected[0])
+                self.assertEqual(values[-1], expected[-1])
+
+        self.assertRaises(IndexError, lambda: values[len(expected)])
+        self.assertRaises(KeyError, values.remove, 100)
+
+    def test_persistent_sorted_set_conflicts(self):
+
+        db = DB(DemoStorage())
+        managers = [transaction.TransactionManager() for i in range(3)]
+
+        root = db.open(managers[2]).root()
+        root['values'] = PersistentSortedIntegerSet(range(0, 2000, 2))
+        managers[2].commit()
+
+        first, second = (db.open(manager).root() for manager in managers[:2])
+
+        # concurrent changes of the values are merged
+        first['values'].add(1001)
+        first['values'].discard(20)
+        second['values'].add(-5)
+        second['values'].discard(1500)
+
+        managers[0].commit()
+        managers[1].commit()
+
+        expected = sorted(set(range(0, 2000, 2)) - set((20, 1500)))
+        expected = [-5] + sorted(expected + [1001])
+
+        # both connections see the merged values once synced
+        managers[0].abort()
+        managers[1].abort()
+
+        for values in (first['values'], second['values']):
+            self.assertEqual(list(values), expected)
+            self.assertEqual(len(values), len(expected))
+            self.assertEqual(values.bisect_left(-5), 0)
+            self.assertEqual(values.bisect_left(1002), 502)
+
+        # splitting buckets conflicts with concurrent changes
+        first['values'].update(range(2001, 2600))
+        second['values'].add(999)
+
+        managers[0].commit()
+        self.assertRaises(ConflictError, managers[1].commit)
+        managers[1].abort()
+
+        db.close()
+
     def test_event_order_index(self):
 
         self.login_testuser()
@@ -291,83 +475,256 @@ class TestEventIndex(IntegrationTestCase):
                     self.assertEqual(len(submitted.index), num_submitted)
                     self.assertEqual(len(published.index), num_published)
 
-    def test_eventorder_metadata(self):
+    def order_index(self, identities=()):
+        """ Returns a published order index of the directory, containing the
+        given identities (in the form of 'yy.mm.dd-HH:MM;id').
 
-        class MockCatalog(object):
+        """
+        orderindex = EventOrderIndex(
+            catalog=MockCatalog(self.directory), state='published'
+        )
+        orderindex.index = PersistentSortedIntegerSet(
+            self.identities(orderindex, identities)
+        )
+        orderindex.set_metadata('identities', None)
 
-            def __init__(self, directory):
-                self.directory = directory
+        return orderindex
 
-        def generate_metadata(testindex):
+    def identities(self, orderindex, identities):
+        return [
+            orderindex.key(
+                datetime.strptime(identity[:14], '%y.%m.%d-%H:%M'),
+                identity[15:]
+            ) for identity in identities
+        ]
 
-            orderindex = EventOrderIndex(
-                catalog=MockCatalog(self.directory), state='published',
-                initial_index=testindex
-            )
+    def test_eventorder_identity(self):
+        orderindex = self.order_index()
 
-            orderindex.generate_metadata()
-            return orderindex.get_metadata('dateindex')
+        identity = self.identities(orderindex, ['13.07.05-18:45;event'])[0]
 
-        dateindex = generate_metadata([
-            '12.01.01-12:00;'
+        self.assertEqual(orderindex.identity_id(identity), 'event')
+        self.assertEqual(
+            orderindex.identity_date(identity),
+            dates.to_utc(datetime(2013, 7, 5, 18, 45))
+        )
+        self.assertEqual(orderindex.identity_day(identity), date(2013, 7, 5))
+        self.assertEqual(
+            orderindex.identity_repr(identity), '13.07.05-18:45;event'
+        )
+
+        # identities are sorted by date first
+        self.assertEqual(
+            sorted(self.identities(orderindex, [
+                '13.07.06-00:00;a', '13.07.05-19:00;b', '13.07.05-18:45;c',
+            ])),
+            self.identities(orderindex, [
+                '13.07.05-18:45;c', '13.07.05-19:00;b', '13.07.06-00:00;a',
+            ])
+        )
+
+    def test_eventorder_by_range(self):
+
+        def by_range(orderindex, start, end):
+            start = dates.to_utc(datetime(start.year, start.month, start.day))
+            end = dates.to_utc(
+                datetime(end.year, end.month, end.day, 23, 59, 59)
+            )
+            return [
+                orderindex.identity_repr(identity)
+                for identity in orderindex.by_range(start, end)
+            ]
+
+        orderindex = self.order_index([
+            '12.01.01-12:00;a'
         ])
 
-        self.assertTrue(date(2012, 1, 1) in dateindex)
-        self.assertEqual(dateindex[date(2012, 1, 1)], 0)
-        self.assertEqual(len(dateindex), 1)
+        self.assertEqual(
+            by_range(orderindex, date(2012, 1, 1), date(2012, 1, 1)),
+            ['12.01.01-12:00;a']
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2012, 1, 2), date(2012, 1, 3)),
+            []
+        )
 
-        dateindex = generate_metadata([
-            '12.01.01-00:00;',
-            '12.01.01-23:59;'
+        orderindex = self.order_index([
+            '12.01.01-00:00;a',
+            '12.01.01-23:59;b'
         ])
 
-        self.assertTrue(date(2012, 1, 1) in dateindex)
-        self.assertEqual(dateindex[date(2012, 1, 1)], 0)
-        self.assertEqual(len(dateindex), 1)
+        self.assertEqual(
+            by_range(orderindex, date(2011, 1, 1), date(2012, 1, 1)),
+            ['12.01.01-00:00;a', '12.01.01-23:59;b']
+        )
 
-        dateindex = generate_metadata([
-            '12.01.01-00:00;',
-            '12.01.01-00:00;',
-            '12.01.02-00:00;'
+        orderindex = self.order_index([
+            '12.01.01-00:00;a',
+            '12.01.01-00:00;b',
+            '12.01.02-00:00;c'
         ])
 
-        self.assertTrue(date(2012, 1, 1) in dateindex)
-        self.assertTrue(date(2012, 1, 2) in dateindex)
-        self.assertEqual(dateindex[date(2012, 1, 1)], 0)
-        self.assertEqual(dateindex[date(2012, 1, 2)], 2)
-        self.assertEqual(len(dateindex), 2)
+        self.assertEqual(
+            by_range(orderindex, date(2012, 1, 1), date(2012, 1, 1)),
+            ['12.01.01-00:00;a', '12.01.01-00:00;b']
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2012, 1, 2), date(2012, 1, 2)),
+            ['12.01.02-00:00;c']
+        )
 
-        dateindex = generate_metadata([
-            '12.01.01-00:00',
-            '12.09.07-00:00',
-            '12.12.31-00:00'
+        orderindex = self.order_index([
+            '12.01.01-00:00;a',
+            '12.09.07-00:00;b',
+            '12.12.31-00:00;c'
         ])
 
-        self.assertEqual(dateindex[date(2012, 1, 1)], 0)
-        self.assertEqual(dateindex[date(2012, 1, 2)], 1)
-        self.assertEqual(dateindex[date(2012, 9, 6)], 1)
-        self.assertEqual(dateindex[date(2012, 9, 7)], 1)
-        self.assertEqual(dateindex[date(2012, 9, 8)], 2)
-        self.assertEqual(dateindex[date(2012, 12, 30)], 2)
-        self.assertEqual(dateindex[date(2012, 12, 31)], 2)
-        self.assertEqual(len(dateindex), 366)
-
-        dateindex = generate_metadata([
-            '13.07.04-14:00;',
-            '13.07.05-18:45;',
-            '13.07.05-19:00;',
-            '13.07.05-19:00;',
-            '13.07.05-19:00;',
-            '13.07.06-19:00;',
+        self.assertEqual(
+            by_range(orderindex, date(2012, 1, 2), date(2012, 9, 6)),
+            []
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2012, 1, 2), date(2012, 9, 7)),
+            ['12.09.07-00:00;b']
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2012, 9, 8), date(2012, 12, 30)),
+            []
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2012, 9, 8), date(2013, 1, 1)),
+            ['12.12.31-00:00;c']
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2011, 1, 1), date(2013, 1, 1)),
+            ['12.01.01-00:00;a', '12.09.07-00:00;b', '12.12.31-00:00;c']
+        )
+
+        orderindex = self.order_index([
+            '13.07.04-14:00;a',
+            '13.07.05-18:45;b',
+            '13.07.05-19:00;c',
+            '13.07.05-19:00;d',
+            '13.07.05-19:00;e',
+            '13.07.06-19:00;f',
         ])
 
-        self.assertTrue(date(2013, 07, 04) in dateindex)
-        self.assertTrue(date(2013, 07, 05) in dateindex)
-        self.assertTrue(date(2013, 07, 06) in dateindex)
+        self.assertEqual(
+            by_range(orderindex, date(2013, 7, 5), date(2013, 7, 5)),
+            [
+                '13.07.05-18:45;b',
+                '13.07.05-19:00;c',
+                '13.07.05-19:00;d',
+                '13.07.05-19:00;e'
+            ]
+        )
+        self.assertEqual(
+            by_range(orderindex, date(2013, 7, 6), date(2013, 7, 6)),
+            ['13.07.06-19:00;f']
+        )
+        self.assertEqual(len(orderindex.by_range(None, None)), 6)
+
+    def test_eventorder_by_subset(self):
+        random = Random(42)
+
+        days = [date(2013, 1, 1) + timedelta(days=d) for d in range(60)]
+        names = ['event%i' % i for i in range(20)]
+
+        orderindex = self.order_index(set(
+            '%s-%02i:%02i;%s' % (
+                random.choice(days).strftime('%y.%m.%d'),
+                random.randint(0, 23), random.choice((0, 30)),
+                random.choice(names)
+            ) for i in range(500)
+        ))
+
+        def as_range(start, end):
+            return (
+                dates.to_utc(datetime(start.year, start.month, start.day)),
+                dates.to_utc(datetime(end.year, end.month, end.day, 23, 59))
+            )
+
+        ranges = [(None, None), as_range(days[0], days[-1])]
+        ranges.extend(
+            as_range(*sorted(random.sample(days, 2))) for i in range(20)
+        )
+        ranges.append(as_range(date(2014, 1, 1), date(2014, 2, 1)))
+
+        for start, end in ranges:
+            for size in (0, 1, 5, 20):
+                subset = set(
+                    orderindex.ids.register(name)
+                    for name in random.sample(names, size)
+                )
+                expected = [
+                    identity for identity in orderindex.by_range(start, end)
+                    if (identity & orderindex.id_mask) in subset
+                ]
+
+                self.assertEqual(
+                    orderindex.by_subset(start, end, IITreeSet(subset)),
+                    expected
+                )
+
+        # events without occurrences are skipped
+        unknown = IITreeSet([orderindex.ids.register('unknown')])
+        self.assertEqual(orderindex.by_subset(None, None, unknown), [])
+
+    def test_eventorder_remove_own_identities(self):
+
+        # removing an event only touches its own occurrences, found through
+        # the reverse index, so it doesn't depend on the size of the index
+        orderindex = self.order_index(['12.01.01-00:00;initial'])
+
+        start = datetime(2012, 1, 1)
+
+        for i in xrange(1000):
+            id = 'event-%i' % i
+            orderindex.replace(id, [
+                orderindex.key(start + timedelta(days=day, minutes=i), id)
+                for day in range(3)
+            ])
+
+        own = set(orderindex.identities['event-500'])
+
+        discard = PersistentSortedIntegerSet.discard
+        add = PersistentSortedIntegerSet.add
+
+        with patch.object(
+            PersistentSortedIntegerSet, 'discard',
+            autospec=True, side_effect=discard
+        ) as discarded:
+            with patch.object(
+                PersistentSortedIntegerSet, 'add',
+                autospec=True, side_effect=add
+            ) as added:
+                removed = orderindex.remove(['event-500'])
+
+        self.assertEqual(removed, own)
+        self.assertEqual(
+            set(args[1] for args, kwargs in discarded.call_args_list), own
+        )
+        self.assertEqual(discarded.call_count, 3)
+        self.assertFalse(added.called)
+
+        self.assertEqual(len(orderindex.index), 999 * 3 + 1)
+        self.assertFalse('event-500' in orderindex.identities)
 
-        self.assertEqual(dateindex[date(2013, 07, 04)], 0)
-        self.assertEqual(dateindex[date(2013, 07, 05)], 1)
-        self.assertEqual(dateindex[date(2013, 07, 06)], 5)
+    def test_attach_reindex_ids(self):
+
+        def data_manager():
+            resources = transaction.get()._resources
+            return [m for m in resources if isinstance(m, ReindexDataManager)]
+
+        # the touched items are collected for an incremental update
+        attach_reindex_to_transaction(self.directory, 'first')
+        attach_reindex_to_transaction(self.directory, 'second')
+        self.assertEqual(data_manager()[0].ids, set(('first', 'second')))
+
+        # without an id the whole directory is reindexed
+        attach_reindex_to_transaction(self.directory)
+        attach_reindex_to_transaction(self.directory, 'third')
+        self.assertEqual(data_manager()[0].ids, None)
 
     def test_attach_reindex_idempotence(self):
 
@@ -416,3 +773,74 @@ class TestEventIndex(IntegrationTestCase):
         dtrange = (datetime(year, 1, 1), datetime(year, 12, 31, 23, 59))
         dtrange = [dates.as_timezone(dt, 'Europe/Vienna') for dt in dtrange]
         self.assertEqual(len(published.by_range(*dtrange)), 1)
+
+    def test_events_by_identities(self):
+        year = date.today().year + 1
+
+        self.login_testuser()
+
+        published = self.catalog.indices['published']
+
+        events = [
+            self.create_event(),
+            self.create_event(recurrence='RRULE:FREQ=DAILY;COUNT=10'),
+            self.create_event(
+                start=datetime(year, 3, 29, 10, 15, 30),
+                end=datetime(year, 3, 29, 11),
+                timezone='Europe/Zurich',
+                recurrence='RRULE:FREQ=DAILY;COUNT=5'
+            ),
+            self.create_event(
+                start=datetime(year, 1, 1, 10),
+                end=datetime(year, 1, 3, 12),
+                recurrence='RRULE:FREQ=WEEKLY;COUNT=3'
+            )
+        ]
+
+        for event in events:
+            event.submit()
+            event.publish()
+
+        transaction.commit()
+
+        identities = list(published.index)
+        self.assertEqual(len(identities), 1 + 10 + 5 + 3 * 3)
+
+        def as_tuple(occurrence):
+            return (
+                occurrence.id, occurrence.start, occurrence.end,
+                occurrence.unsplit_start, occurrence.unsplit_end
+            )
+
+        resolved = published.events_by_identities(identities)
+        reals = dict((event.id, event) for event in events)
+
+        for identity, occurrence in zip(identities, resolved):
+            spawned = published.spawned_occurrence(
+                reals[occurrence.id], published.identity_date(identity)
+            )
+            self.assertEqual(as_tuple(occurrence), as_tuple(spawned))
+            self.assertEqual(published.identity(occurrence), identity)
+
+        lazy = published.lazy_list(
+            dates.to_utc(datetime(2000, 1, 1)),
+            dates.to_utc(datetime(2100, 1, 1))
+        )
+        self.assertEqual(map(as_tuple, lazy[:]), map(as_tuple, resolved))
+
+        # resolved occurrences are kept until the index changes
+        published.resolved.hits = 0
+        self.assertEqual(published.event_by_identity(identities[0]).id,
+                         resolved[0].id)
+        self.assertEqual(published.resolved.hits, 1)
+
+        # more identities than the cache holds are resolved all the same
+        published.resolved = utils.LRUCache(5)
+        self.assertEqual(
+            map(as_tuple, published.events_by_identities(identities)),
+            map(as_tuple, resolved)
+        )
+        self.assertEqual(len(published.resolved), 5)
+
+        published.remove([events[0].id])
+        self.assertEqual(len(published.resolved), 0)
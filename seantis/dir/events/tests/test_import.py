@@ -2,18 +2,32 @@ import mock
 import pytz
 import transaction
 
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from collective.geo.geographer.interfaces import IGeoreferenced
 from datetime import datetime, timedelta
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from plone.app.event.base import default_timezone
 from plone.dexterity.utils import createContentInContainer
 from seantis.dir.events.catalog import reindex_directory
 from seantis.dir.events.dates import default_now
+from seantis.dir.events.interfaces import NoImportDataException
 from seantis.dir.events.sources import ExternalEventImporter, IExternalEvent
+from seantis.dir.events.sources import (
+    conditional_download,
+    fingerprint,
+    get_validators,
+    prefetch,
+    prefetched,
+    set_validators
+)
 from seantis.dir.events.sources.guidle import EventsSourceGuidle
 from seantis.dir.events.sources.seantis_json import EventsSourceSeantisJson
 from seantis.dir.events.sources.ical import EventsSourceIcal
 
 from seantis.dir.events.tests import IntegrationTestCase
+from threading import Thread
+from urllib2 import HTTPError
 from zope.interface import alsoProvides
 
 
@@ -341,9 +355,10 @@ class TestImport(IntegrationTestCase):
             importer = ExternalEventImporter(self.directory)
             events = []
             fetch = lambda: events
-            from_ids = lambda ids: [self.create_fetch_entry(source_id=id,
-                                                            fetch_id='f')
-                                    for id in ids]
+            from_ids = lambda ids, **kw: [
+                self.create_fetch_entry(source_id=id, fetch_id='f', **kw)
+                for id in ids
+            ]
 
             # Simple import
             ids = ['event1', 'event2', 'event3', 'event4',
@@ -351,6 +366,7 @@ class TestImport(IntegrationTestCase):
             events = from_ids(ids[:4])
             imports, deleted = importer.fetch_one('source', fetch)
             self.assertEquals(imports, 4)
+            self.assertTrue(importer.complete)
             imported = [i.getObject().source_id for i in self.catalog.query()]
             self.assertEquals(ids[:4], imported)
 
@@ -358,9 +374,11 @@ class TestImport(IntegrationTestCase):
             events = from_ids(ids[4:])
             imports, deleted = importer.fetch_one('source', fetch, limit=2)
             self.assertEquals(imports, 2)
+            self.assertFalse(importer.complete)
             self.assertEquals(len(self.catalog.query()), 6)
             imports, deleted = importer.fetch_one('source', fetch)
             self.assertEquals(imports, 2)
+            self.assertTrue(importer.complete)
             self.assertEquals(len(self.catalog.query()), 8)
 
             # Force reimport
@@ -373,7 +391,7 @@ class TestImport(IntegrationTestCase):
             self.assertEquals(len(self.catalog.query()), 8)
 
             # Reimport updated events
-            events = from_ids(ids)
+            events = from_ids(ids, title='updated')
             imports, deleted = importer.fetch_one('source', fetch)
             self.assertEquals(imports, 8)
             self.assertEquals(len(self.catalog.query()), 8)
@@ -390,6 +408,39 @@ class TestImport(IntegrationTestCase):
             # Clean up (transaction has been commited)
             self.cleanup_after_fetch_one()
 
+    def test_importer_deferred_reindex(self):
+        try:
+            importer = ExternalEventImporter(
+                self.directory, defer_reindex=True
+            )
+            events = [
+                self.create_fetch_entry(source_id=id, fetch_id='f')
+                for id in ('event1', 'event2')
+            ]
+
+            external = lambda: self.catalog.catalog(
+                object_provides=IExternalEvent.__identifier__
+            )
+            ix = self.catalog.indices['published']
+
+            # the events are cataloged on creation, but not yet as external
+            # events and not in the indices of the directory
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 2)
+            self.assertEquals(len(importer.reindex_queue), 2)
+            self.assertEquals(len(external()), 0)
+            self.assertEquals(len(ix.index or ()), 0)
+
+            importer.reindex()
+            self.assertEquals(len(importer.reindex_queue), 0)
+            self.assertEquals(len(external()), 2)
+            self.assertEquals(len(ix.index), 2)
+            self.assertEquals(len(self.catalog.lazy_list), 2)
+
+        finally:
+            # Clean up (transaction has been commited)
+            self.cleanup_after_fetch_one()
+
     def test_importer_update_category_suggestions(self):
         try:
             importer = ExternalEventImporter(self.directory)
@@ -564,6 +615,270 @@ class TestImport(IntegrationTestCase):
             # Clean up (transaction has been commited)
             self.cleanup_after_fetch_one()
 
+    def test_importer_update_in_place(self):
+        try:
+            importer = ExternalEventImporter(self.directory)
+            brains = lambda: self.catalog.catalog(
+                object_provides=IExternalEvent.__identifier__
+            )
+
+            # Import event
+            event = self.create_fetch_entry(
+                source_id='s', fetch_id='f', title='before'
+            )
+            imports, deleted = importer.fetch_one('source', lambda: [event])
+            self.assertEquals(imports, 1)
+
+            original = brains()[0].getObject()
+            uid = original.UID()
+            original.hide()
+
+            # Update event
+            event = self.create_fetch_entry(
+                source_id='s', fetch_id='f', title='after',
+                start=event['start'], end=event['end'],
+                last_update=event['last_update'] + timedelta(seconds=1)
+            )
+            imports, deleted = importer.fetch_one('source', lambda: [event])
+            self.assertEquals(imports, 1)
+
+            self.assertEquals(len(brains()), 1)
+            updated = brains()[0].getObject()
+            self.assertEquals(updated.UID(), uid)
+            self.assertEquals(updated.title, 'after')
+            self.assertEquals(updated.review_state, 'hidden')
+            self.assertFalse(importer.update_event(
+                updated, event, None, (set(), set())
+            ))
+
+            # An update which changes nothing is not counted
+            importer.get_fingerprints().clear()
+            event = self.create_fetch_entry(
+                source_id='s', fetch_id='f', title='after',
+                start=event['start'], end=event['end'],
+                last_update=event['last_update'] + timedelta(seconds=1)
+            )
+            imports, deleted = importer.fetch_one('source', lambda: [event])
+            self.assertEquals(imports, 0)
+            self.assertEquals(brains()[0].getObject().UID(), uid)
+
+            # A changed number of events recreates the events
+            events = [
+                self.create_fetch_entry(
+                    source_id='s', fetch_id='f',
+                    last_update=event['last_update'] + timedelta(seconds=1)
+                ) for i in range(2)
+            ]
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 2)
+
+            self.assertEquals(len(brains()), 2)
+            self.assertTrue(uid not in [b.UID for b in brains()])
+
+        finally:
+            # Clean up (transaction has been commited)
+            self.cleanup_after_fetch_one()
+
+    def test_importer_fingerprints(self):
+        try:
+            importer = ExternalEventImporter(self.directory)
+            start = datetime.today().replace(microsecond=0)
+            entry = lambda **kw: self.create_fetch_entry(
+                source_id='s', fetch_id='f', start=start,
+                end=start + timedelta(hours=1),
+                last_update=default_now().replace(microsecond=0), **kw
+            )
+
+            events = [entry(title='a')]
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 1)
+
+            # a newer last_update alone does not import the event again
+            events = [entry(title='a')]
+            events[0]['last_update'] += timedelta(seconds=1)
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 0)
+
+            # a changed content does
+            events = [entry(title='b')]
+            events[0]['last_update'] += timedelta(seconds=2)
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 1)
+
+            # as does a reimport
+            events = [entry(title='b')]
+            imports, deleted = importer.fetch_one(
+                'source', lambda: events, reimport=True
+            )
+            self.assertEquals(imports, 1)
+
+            self.assertEquals(
+                importer.get_fingerprints()['s'],
+                fingerprint([entry(title='b')])
+            )
+
+        finally:
+            # Clean up (transaction has been commited)
+            self.cleanup_after_fetch_one()
+
+    def test_importer_fingerprints_multiple_events(self):
+        try:
+            importer = ExternalEventImporter(self.directory)
+            start = datetime.today().replace(microsecond=0)
+            last_update = default_now().replace(microsecond=0)
+            entries = lambda title, last_update: [
+                self.create_fetch_entry(
+                    source_id='s', fetch_id='f', title=title,
+                    start=start + timedelta(days=day),
+                    end=start + timedelta(days=day, hours=1),
+                    last_update=last_update
+                ) for day in range(3)
+            ]
+
+            events = entries('a', last_update)
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 3)
+
+            # all events of a changed source_id are updated
+            events = entries('b', last_update + timedelta(seconds=1))
+            imports, deleted = importer.fetch_one('source', lambda: events)
+            self.assertEquals(imports, 3)
+
+            brains = self.catalog.catalog(
+                object_provides=IExternalEvent.__identifier__
+            )
+            self.assertEquals(
+                sorted(brain.getObject().title for brain in brains),
+                ['b', 'b', 'b']
+            )
+            self.assertEquals(
+                importer.get_fingerprints()['s'],
+                fingerprint(entries('b', last_update))
+            )
+
+        finally:
+            # Clean up (transaction has been commited)
+            self.cleanup_after_fetch_one()
+
+    @mock.patch('seantis.dir.events.sources.ExternalEventImporter.download')
+    def test_importer_reuse_files(self, download):
+        try:
+            importer = ExternalEventImporter(self.directory)
+            brains = lambda: self.catalog.catalog(
+                object_provides=IExternalEvent.__identifier__
+            )
+            download.return_value = 'image'
+
+            event = self.create_fetch_entry(
+                source_id='s', fetch_id='f', image='http://a/1.png'
+            )
+            importer.fetch_one('source', lambda: [event])
+            image = brains()[0].getObject().image
+
+            # the same content at another url is the same file
+            events = [
+                self.create_fetch_entry(
+                    source_id='s', fetch_id='f', image='http://a/2.png',
+                    last_update=event['last_update'] + timedelta(seconds=1)
+                ) for i in range(2)
+            ]
+            importer.fetch_one('source', lambda: events)
+
+            self.assertEquals(len(brains()), 2)
+            for brain in brains():
+                self.assertEquals(brain.getObject().image._p_oid, image._p_oid)
+
+            # a renamed file is copied, as the file is shared
+            for event in events:
+                event['last_update'] += timedelta(seconds=1)
+                event['image'] = 'http://a/2.png'
+            events[0]['image_name'] = u'renamed.png'
+            importer.fetch_one('source', lambda: events)
+
+            images = [brain.getObject().image for brain in brains()]
+            self.assertEquals(
+                sorted(i.filename for i in images), [None, u'renamed.png']
+            )
+            self.assertEquals(
+                sorted(i._p_oid == image._p_oid for i in images),
+                [False, True]
+            )
+            self.assertEquals(image.filename, None)
+
+            # changed content is not
+            download.return_value = 'other image'
+            for event in events:
+                event['last_update'] += timedelta(seconds=1)
+                event['image'] = 'http://a/2.png'
+            importer.fetch_one('source', lambda: events)
+
+            for brain in brains():
+                self.assertEquals(brain.getObject().image.data, 'other image')
+
+        finally:
+            # Clean up (transaction has been commited)
+            self.cleanup_after_fetch_one()
+
+    @mock.patch('seantis.dir.events.sources.ExternalEventImporter.download')
+    @mock.patch(
+        'seantis.dir.events.sources.ExternalEventImporter.prefetch_downloads'
+    )
+    def test_importer_prefetch_limit(self, prefetch_downloads, download):
+        try:
+            importer = ExternalEventImporter(self.directory)
+            download.return_value = 'image'
+
+            events = [
+                self.create_fetch_entry(
+                    source_id=id, fetch_id='f', image='http://a/%s.png' % id
+                ) for id in ('a', 'b', 'b', 'c')
+            ]
+
+            # only the files of the events up to the limit are downloaded,
+            # including the other events of the same source_id
+            imports, deleted = importer.fetch_one(
+                'source', lambda: events, limit=2
+            )
+            self.assertEquals(imports, 3)
+            self.assertEquals(prefetch_downloads.call_args[0][0], [
+                'http://a/a.png', 'http://a/b.png', 'http://a/b.png'
+            ])
+
+        finally:
+            # Clean up (transaction has been commited)
+            self.cleanup_after_fetch_one()
+
+    @mock.patch('seantis.dir.events.sources.cache')
+    def test_importer_prefetch_downloads(self, cache):
+        def get(url):
+            if url.endswith('missing.png'):
+                raise HTTPError(url, 404, 'Not Found', {}, None)
+            return url
+
+        cache.return_value.get.side_effect = get
+        cache.return_value.read.side_effect = lambda url: (url, None)
+
+        importer = ExternalEventImporter(self.directory)
+        importer.prefetch_downloads([
+            'http://a/1.png', 'http://a/2.png', 'http://b/1.png',
+            'http://a/1.png', 'http://b/missing.png'
+        ])
+
+        self.assertEqual(importer.downloaded, set([
+            'http://a/1.png', 'http://a/2.png', 'http://b/1.png'
+        ]))
+        self.assertEqual(cache.return_value.get.call_count, 4)
+
+        # prefetched files are read from the cache
+        self.assertEqual(importer.download('http://a/2.png'), 'http://a/2.png')
+        self.assertEqual(cache.return_value.get.call_count, 4)
+
+        # others are downloaded
+        self.assertRaises(
+            HTTPError, importer.download, 'http://b/missing.png'
+        )
+        self.assertEqual(cache.return_value.get.call_count, 5)
+
     def test_importer_export_imported(self):
         try:
             # Import event
@@ -661,6 +976,147 @@ class TestImport(IntegrationTestCase):
                           'RRULE:FREQ=DAILY;UNTIL=20140215T0000Z')
         self.assertEquals(events[3]['whole_day'], False)
 
+    def test_guidle_offers(self):
+        source = EventsSourceGuidle(mock.Mock())
+
+        ids = []
+        for offer in source.offers(GUIDLE_TEST_DATA):
+            ids.append(offer.attrib['id'])
+
+            # processed offers are discarded
+            self.assertEquals(offer.getprevious(), None)
+
+        self.assertEquals(ids, ['123', '234', '50_1', '50_2'])
+
+        self.assertRaises(
+            NoImportDataException, list, source.fetch(GUIDLE_TEST_DATA[:-50])
+        )
+
+        # without an export the offers are read from the response
+        with mock.patch('seantis.dir.events.sources.guidle.urlopen') as url:
+            response = url.return_value = BytesIO(GUIDLE_TEST_DATA)
+
+            events = list(source.fetch())
+            self.assertEquals(events, list(source.fetch(GUIDLE_TEST_DATA)))
+            self.assertTrue(response.closed)
+
+    def test_validators(self):
+        source = self.create_guidle_source()
+        self.assertEquals(get_validators(source, 'url'), None)
+
+        set_validators(source, 'url', ('"1"', 'Wed, 01 Jan 2014'))
+        self.assertEquals(
+            get_validators(source, 'url'), ('"1"', 'Wed, 01 Jan 2014')
+        )
+
+        # the validators of another url are not sent
+        self.assertEquals(get_validators(source, 'other'), None)
+
+    @mock.patch('seantis.dir.events.downloads.urlopen')
+    def test_prefetch(self, urlopen):
+
+        def respond(data):
+            response = BytesIO(data)
+            response.info = lambda: {}
+            urlopen.side_effect = lambda *args, **kwargs: response
+
+        respond(GUIDLE_TEST_DATA)
+
+        context = mock.Mock()
+        context.url = 'url'
+
+        source = EventsSourceGuidle(context)
+        pool = ThreadPool(2)
+
+        try:
+            result = pool.apply_async(
+                prefetch, (source.build_url(), source.parse, None, True)
+            )
+            offers, seconds, validators, modified = result.get()
+            self.assertTrue(seconds >= 0)
+            self.assertEquals(validators, (None, None))
+            self.assertTrue(modified)
+            self.assertEquals(urlopen.call_args[0][0].get_full_url(), 'url')
+
+            events = list(prefetched(source, result)())
+            self.assertEquals(events, list(source.fetch(GUIDLE_TEST_DATA)))
+
+            # unreadable sources are not imported
+            respond('no xml')
+            result = pool.apply_async(
+                prefetch, (source.build_url(), source.parse, None, True)
+            )
+            self.assertRaises(
+                NoImportDataException, list, prefetched(source, result)()
+            )
+
+            # neither are sources that could not be downloaded
+            urlopen.side_effect = IOError
+            result = pool.apply_async(
+                prefetch, (source.build_url(), source.parse, None, True)
+            )
+            self.assertEquals(result.get()[0], None)
+            self.assertRaises(
+                NoImportDataException, prefetched(source, result)
+            )
+        finally:
+            pool.terminate()
+
+    def test_conditional_download(self):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.headers.get('If-None-Match') == '"1"':
+                    self.send_response(304)
+                    self.end_headers()
+                else:
+                    self.send_response(200)
+                    self.send_header('ETag', '"1"')
+                    self.send_header('Last-Modified', 'Wed, 01 Jan 2014')
+                    self.end_headers()
+                    self.wfile.write(GUIDLE_TEST_DATA)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+
+        try:
+            url = 'http://127.0.0.1:%i/' % server.server_port
+
+            data, validators = conditional_download(url)
+            self.assertEquals(data, GUIDLE_TEST_DATA)
+            self.assertEquals(validators, ('"1"', 'Wed, 01 Jan 2014'))
+
+            data, validators = conditional_download(url, validators)
+            self.assertEquals(data, None)
+            self.assertEquals(validators, ('"1"', 'Wed, 01 Jan 2014'))
+
+            # large downloads may be spooled to a file
+            data, validators = conditional_download(url, spool=True)
+            self.assertEquals(data.read(), GUIDLE_TEST_DATA)
+            self.assertEquals(validators, ('"1"', 'Wed, 01 Jan 2014'))
+
+            source = EventsSourceGuidle(mock.Mock())
+            parsed, seconds, validators, modified = prefetch(
+                url, source.parse, validators
+            )
+            self.assertEquals(parsed, None)
+            self.assertFalse(modified)
+
+            parsed, seconds, validators, modified = prefetch(
+                url, source.parse, ('"0"', None), source.streaming
+            )
+            self.assertEquals(len(list(parsed)), 4)
+            self.assertTrue(modified)
+            self.assertEquals(validators, ('"1"', 'Wed, 01 Jan 2014'))
+
+        finally:
+            server.shutdown()
+            thread.join()
+
     def test_seantis_import(self):
         json_string = """[{
             "id": "id1", "title": "title",
@@ -4,6 +4,7 @@ import pytz
 import mock
 
 from datetime import datetime, timedelta, date
+from random import Random
 
 from zope.publisher.browser import TestRequest
 
@@ -116,6 +117,187 @@ class TestRecurrence(IntegrationTestCase):
 
         self.assertEqual(occurrences, [non_recurrant])
 
+    def test_occurrences_expansion_cache(self):
+        recurrence.expansions.clear()
+        hits, misses = recurrence.expansions.hits, recurrence.expansions.misses
+
+        item = Item(
+            datetime(2012, 1, 1, 10, 0),
+            datetime(2012, 1, 1, 12, 0),
+            "RRULE:FREQ=DAILY;COUNT=4"
+        )
+
+        min_date = datetime(2012, 1, 1, 0, 0, tzinfo=item.tz)
+        max_date = datetime(2012, 12, 31, 0, 0, tzinfo=item.tz)
+
+        first = recurrence.occurrences(item, min_date, max_date)
+        second = recurrence.occurrences(item, min_date, max_date)
+
+        self.assertEqual(recurrence.expansions.misses, misses + 1)
+        self.assertEqual(recurrence.expansions.hits, hits + 1)
+        self.assertEqual(
+            [o.start for o in first], [o.start for o in second]
+        )
+
+        # a changed item doesn't get the occurrences of the old rule
+        item.recurrence = "RRULE:FREQ=DAILY;COUNT=2"
+        self.assertEqual(
+            len(recurrence.occurrences(item, min_date, max_date)), 2
+        )
+        self.assertEqual(recurrence.expansions.misses, misses + 2)
+
+        item.start += timedelta(days=1)
+        item.end += timedelta(days=1)
+        occurrences = recurrence.occurrences(item, min_date, max_date)
+        self.assertEqual([o.start.day for o in occurrences], [2, 3])
+        self.assertEqual(recurrence.expansions.misses, misses + 3)
+
+        # other windows are expanded separately
+        occurrences = recurrence.occurrences(
+            item, min_date + timedelta(days=2), max_date
+        )
+        self.assertEqual([o.start.day for o in occurrences], [3])
+        self.assertEqual(len(recurrence.expansions), 4)
+
+    def test_simple_rule(self):
+        start = datetime(2013, 1, 1, 10)  # a tuesday
+
+        self.assertEqual(
+            recurrence.simple_rule('RRULE:FREQ=DAILY', start),
+            (set(range(7)), None)
+        )
+        self.assertEqual(
+            recurrence.simple_rule('RRULE:FREQ=WEEKLY', start),
+            (set([1]), None)
+        )
+        self.assertEqual(
+            recurrence.simple_rule(
+                'RRULE:FREQ=WEEKLY;BYDAY=MO,FR;UNTIL=20130201T1000Z', start
+            ),
+            (set([0, 4]), datetime(2013, 2, 1, 10))
+        )
+        self.assertEqual(
+            recurrence.simple_rule(
+                'RRULE:FREQ=DAILY;UNTIL=20130201T000000Z',
+                datetime(2013, 1, 1)
+            ),
+            (set(range(7)), datetime(2013, 2, 1, 23, 59, 59))
+        )
+
+        for rule in (
+            'RRULE:FREQ=MONTHLY',
+            'RRULE:FREQ=DAILY;COUNT=10',
+            'RRULE:FREQ=WEEKLY;INTERVAL=2',
+            'RRULE:FREQ=WEEKLY;BYDAY=1MO',
+            'RRULE:FREQ=DAILY;UNTIL=20130201T000000Z',
+            'RRULE:FREQ=DAILY\nEXDATE:20130102T100000',
+            'RDATE:20130102T100000'
+        ):
+            self.assertEqual(recurrence.simple_rule(rule, start), None)
+
+    def test_simple_sequence(self):
+        rules = (
+            'RRULE:FREQ=DAILY',
+            'RRULE:FREQ=DAILY;UNTIL=20130401T0000Z',
+            'RRULE:FREQ=DAILY;UNTIL=20130331T235959Z',
+            'RRULE:FREQ=WEEKLY',
+            'RRULE:FREQ=WEEKLY;BYDAY=MO,WE,SU',
+            'RRULE:FREQ=WEEKLY;BYDAY=SA,SU;UNTIL=20131027T0230Z',
+            'RRULE:FREQ=WEEKLY;BYDAY=MO,TU,WE,TH,FR;UNTIL=20121231T1000Z',
+        )
+        starts = (
+            datetime(2013, 1, 1, 10), datetime(2013, 3, 30, 2, 30),
+            datetime(2013, 10, 26, 2, 30), datetime(2013, 1, 1)
+        )
+        windows = (
+            (datetime(2012, 1, 1), datetime(2014, 1, 1)),
+            (datetime(2013, 3, 31, 1), datetime(2013, 10, 27, 1)),
+            (datetime(2013, 1, 1, 9), datetime(2013, 1, 1, 9)),
+            (datetime(2013, 1, 5), datetime(2020, 1, 1)),
+        )
+
+        for timezone in ('Europe/Zurich', 'UTC', 'America/New_York'):
+            tz = pytz.timezone(timezone)
+
+            for rule in rules:
+                for start in starts:
+                    start = tz.localize(start)
+
+                    for window in windows:
+                        from_, until = map(dates.to_utc, window)
+
+                        simple = recurrence.simple_sequence(
+                            rule, start, from_, until
+                        )
+                        generic = list(recurrence.recurrence_sequence_ical(
+                            start, recrule=rule, from_=from_, until=until
+                        ))
+
+                        self.assertEqual(simple, generic)
+                        self.assertEqual(
+                            [s.tzinfo for s in simple],
+                            [g.tzinfo for g in generic]
+                        )
+
+    def test_simple_sequence_random(self):
+        random = Random(42)
+        days = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+        tz = pytz.timezone('Europe/Zurich')
+
+        # random simple rules, starts and windows yield the same sequence
+        # as the generic recurrence iterator
+        for i in xrange(500):
+            start = tz.localize(datetime(2012, 1, 1) + timedelta(
+                days=random.randint(0, 730),
+                minutes=random.choice((0, 150, 600, 1425))
+            ))
+
+            rule = random.choice((
+                'RRULE:FREQ=DAILY',
+                'RRULE:FREQ=WEEKLY',
+                'RRULE:FREQ=WEEKLY;BYDAY=%s' % ','.join(
+                    random.sample(days, random.randint(1, 7))
+                )
+            ))
+
+            if random.random() < 0.5:
+                rule_until = start + timedelta(days=random.randint(0, 365))
+                rule += ';UNTIL=%s' % rule_until.astimezone(
+                    pytz.utc
+                ).strftime('%Y%m%dT%H%MZ')
+
+            from_ = dates.to_utc(
+                datetime(2012, 1, 1) + timedelta(days=random.randint(0, 730))
+            )
+            until = from_ + timedelta(days=random.randint(0, 1000))
+
+            simple = recurrence.simple_sequence(rule, start, from_, until)
+            generic = list(recurrence.recurrence_sequence_ical(
+                start, recrule=rule, from_=from_, until=until
+            ))
+
+            self.assertEqual(simple, generic, rule)
+
+    def test_localize_sorted(self):
+        walls = [
+            datetime(2013, 3, 31, 1, 30) + timedelta(hours=h)
+            for h in xrange(-96, 96)
+        ] + [
+            datetime(2013, 10, 27, 1, 30) + timedelta(hours=h)
+            for h in xrange(-96, 96)
+        ]
+
+        for timezone in ('Europe/Zurich', 'UTC', 'Australia/Sydney'):
+            tz = pytz.timezone(timezone)
+
+            localized = dates.localize_sorted(tz, walls)
+            expected = [tz.localize(wall) for wall in walls]
+
+            self.assertEqual(localized, expected)
+            self.assertEqual(
+                [l.tzinfo for l in localized], [e.tzinfo for e in expected]
+            )
+
     def test_split_days(self):
         # split needed?
 
@@ -374,3 +374,25 @@ def upgrade_1021_to_1022(context):
     setup = getToolByName(context, 'portal_setup')
     profile = 'profile-seantis.dir.events:default'
     setup.runImportStepFromProfile(profile, 'typeinfo')
+
+
+def upgrade_1022_to_1023(context):
+    # The event order indices are stored differently now and the category
+    # indices were added, the old indices are removed and the new ones are
+    # built once by the catalog of each directory
+    catalog = getToolByName(context, 'portal_catalog')
+    brains = catalog(object_provides=IEventsDirectory.__identifier__)
+
+    prefixes = tuple('seantis.dir.events.' + name for name in (
+        'eventorder-', 'categories-', 'eventids-'
+    ))
+
+    for brain in brains:
+        directory = brain.getObject()
+        annotations = IAnnotations(directory)
+
+        for key in list(annotations.keys()):
+            if key.startswith(prefixes):
+                del annotations[key]
+
+        IDirectoryCatalog(directory)
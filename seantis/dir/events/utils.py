@@ -1,10 +1,13 @@
+import email.utils
 import functools
+import hashlib
 import json
 import pytz
-import string
+import threading
 import urllib
 
-from collections import defaultdict
+from calendar import timegm
+from collections import OrderedDict
 from collective.geo.geographer.interfaces import IGeoreferenced
 from plone.namedfile import NamedFile
 from Products.CMFCore.utils import getToolByName
@@ -18,6 +21,56 @@ def get_catalog(directory):
     return getAdapter(directory, IDirectoryCatalog)
 
 
+class LRUCache(object):
+    """ A mapping holding a limited number of values, dropping the least
+    recently used values first. Counts the hits and misses of get.
+
+    If a weight function is given, the size limits the total weight of the
+    values instead of their number.
+
+    """
+
+    def __init__(self, size, weight=None):
+        self.size = size
+        self.weight = weight or (lambda value: 1)
+        self.total = 0
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.values.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.values[key] = value
+        self.hits += 1
+
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.values:
+            self.total -= self.weight(self.values.pop(key))
+
+        self.values[key] = value
+        self.total += self.weight(value)
+
+        while self.total > self.size:
+            self.total -= self.weight(self.values.popitem(last=False)[1])
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def clear(self):
+        self.values.clear()
+        self.total = 0
+
+
 def get_current_language(request):
     """ Returns the current language """
     portal_state = getMultiAdapter(
@@ -36,17 +89,126 @@ def render_ical_response(request, context, calendar):
     request.RESPONSE.setHeader('Content-Type', 'text/calendar; charset=UTF-8')
     request.RESPONSE.setHeader('Content-Disposition',
                                'attachment; filename="%s"' % name)
+
+    # the calendar may already be serialized
+    if isinstance(calendar, basestring):
+        return calendar
+
     return calendar.to_ical()
 
 
-def render_json_response(request, items, compact):
+# the json exports last rendered, by etag
+json_snapshots = LRUCache(20)
+json_snapshots_lock = threading.Lock()
+
+# larger exports are always rendered, to keep the memory use bounded
+json_snapshot_limit = 2 * 1024 * 1024
+
+
+def render_cached_json_response(request, key, modified, export, compact):
+    """ Renders the json export identified by the given key (which changes
+    whenever the exported events change) and last modified at the given
+    date. The events are written to the response one chunk at a time.
+
+    Conditional requests for an unchanged export are answered with a 304.
+    Other requests are served from the snapshots of the last exports if
+    possible, with the export function only called for missing snapshots.
+
+    """
+    etag = '"%s"' % hashlib.md5(repr(key)).hexdigest()
+
+    request.response.setHeader("ETag", etag)
+
+    if modified:
+        request.response.setHeader(
+            "Last-Modified", email.utils.formatdate(
+                timegm(modified.utctimetuple()), usegmt=True
+            )
+        )
+
+    if is_not_modified(request, etag, modified):
+        request.response.setStatus(304)
+        return ''
+
+    with json_snapshots_lock:
+        snapshot = json_snapshots.get(etag)
+
     request.response.setHeader("Content-Type", "application/json")
     request.response.setHeader("Access-Control-Allow-Origin", "*")  # CORS
 
+    if snapshot is not None:
+        return snapshot
+
+    chunks = []
+    size = [0]
+
+    def write(data):
+        request.response.write(data)
+
+        if size[0] <= json_snapshot_limit:
+            chunks.append(data)
+            size[0] += len(data)
+
+    write_json(write, export(), compact)
+
+    if size[0] <= json_snapshot_limit:
+        with json_snapshots_lock:
+            json_snapshots[etag] = ''.join(chunks)
+
+    return ''
+
+
+def is_not_modified(request, etag, modified):
+    """ Returns true if the conditional headers of the request match the
+    given etag or last modified date. """
+
+    if_none_match = request.getHeader('If-None-Match')
+
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return etag in tags or '*' in tags
+
+    if_modified_since = request.getHeader('If-Modified-Since')
+
+    if if_modified_since and modified:
+        since = email.utils.parsedate_tz(if_modified_since.split(';')[0])
+
+        if since is not None:
+            return email.utils.mktime_tz(since) >= \
+                timegm(modified.utctimetuple())
+
+    return False
+
+
+def write_json(write, items, compact, chunk_size=100):
+    """ Writes the given items as json list using the given write function,
+    one chunk of events at a time.
+
+    """
+    separator = ''
+
+    write('[')
+
+    chunk = []
+    for event in json_events(items, compact):
+        chunk.append(json.dumps(event))
+
+        if len(chunk) == chunk_size:
+            write(separator + ', '.join(chunk))
+            separator, chunk = ', ', []
+
+    if chunk:
+        write(separator + ', '.join(chunk))
+
+    write(']')
+
+
+def json_events(items, compact):
+    """ Yields the given items as dictionaries for the json export. """
+
     utc = pytz.timezone('utc')
     duplicates = set()
 
-    result = []
     for idx, item in enumerate(items):
         if compact:
             if item.id in duplicates:
@@ -124,9 +286,7 @@ def render_json_response(request, items, compact):
         except TypeError:
             pass
 
-        result.append(event)
-
-    return json.dumps(result)
+        yield event
 
 
 def workflow_tool():
@@ -160,35 +320,6 @@ def webcal(fn):
     return wrapper
 
 
-def terms_match(item, term):
-    """ Returns if an item matches the given terms: At least one item of each
-    given categories must be present. """
-
-    item_categories = item.categories
-    if callable(item.categories):
-        item_categories = item.categories()
-
-    categories = defaultdict(list)
-    for category, label, value in item_categories:
-        if isinstance(value, basestring):
-            categories[category].extend((value.strip(), ))
-        else:
-            categories[category].extend(map(string.strip, value))
-
-    for key, term_values in term.items():
-
-        if not term_values or term_values == '!empty':
-            continue
-
-        if isinstance(term_values, basestring):
-            term_values = (term_values, )
-
-        if not set(categories[key]) & set(term_values):
-            return False
-
-    return True
-
-
 def recurrence_url(directory, event):
     baseurl = directory.absolute_url()
     baseurl += '?range=this_and_next_year&search=true&searchtext=%s'
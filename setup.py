@@ -72,7 +72,6 @@ setup(name=name, version=version, description=description,
           'pytz',
           'python-magic',
           'lxml',
-          'blist',
           'functools32',
           'isodate',
           'icalendar>=3.9.2',